@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to compute statistics over a sliding window of event values.
+
+    Statistics are updated incrementally for each sample, so querying them
+    doesn't depend on the number of samples in the window.
+"""
+
+import math
+from collections import deque
+
+class WindowedStats:
+    """
+        Statistics of the values received during the last window seconds
+
+        Mean and variance use running sums of the values shifted by a value
+        of the window, so values far from zero don't lose precision. The
+        sums are computed again from the window once as many values as it
+        held have expired, which also drops the rounding errors of the
+        removals. Minimum and maximum use monotonic deques. Quantiles are
+        approximated with a fixed number of bins over the range of the
+        values, values out of the range being counted in the first or the
+        last bin.
+        :param window: The length of the window, in seconds
+        :param value_range: A tuple of min and max value, for quantiles
+        :param bins: The number of bins used to approximate quantiles
+    """
+    def __init__(self, window, value_range=(0, 100), bins=200):
+        self.window = window
+        self.low, self.high = value_range
+        self.bins = bins
+        self.histogram = [0] * bins
+        self.samples = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.shift = 0.0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.rebase_countdown = 0
+
+    def _bin(self, value):
+        index = int((value - self.low) * self.bins / (self.high - self.low))
+        return min(max(index, 0), self.bins - 1)
+
+    def _expire(self, timestamp):
+        limit = timestamp - self.window
+        while self.samples and self.samples[0][0] <= limit:
+            _, value = self.samples.popleft()
+            delta = value - self.shift
+            self.total -= delta
+            self.total_squares -= delta * delta
+            self.histogram[self._bin(value)] -= 1
+            self.rebase_countdown -= 1
+            if self.rebase_countdown <= 0:
+                self._rebase()
+        while self.mins and self.mins[0][0] <= limit:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] <= limit:
+            self.maxs.popleft()
+
+    def _rebase(self):
+        self.shift = self.samples[0][1] if self.samples else 0.0
+        deltas = [value - self.shift for _, value in self.samples]
+        self.total = math.fsum(deltas)
+        self.total_squares = math.fsum(delta * delta for delta in deltas)
+        self.rebase_countdown = len(self.samples)
+
+    def add(self, timestamp, value):
+        """
+            Add a value, and drop the values out of the window
+
+            :param timestamp: The time of the value, in seconds
+            :param value: The value, ignored if None or NaN
+        """
+        self._expire(timestamp)
+        if value is None or math.isnan(value):
+            return
+        if not self.samples:
+            self.shift = value
+            self.rebase_countdown = 1
+        self.samples.append((timestamp, value))
+        delta = value - self.shift
+        self.total += delta
+        self.total_squares += delta * delta
+        self.histogram[self._bin(value)] += 1
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((timestamp, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((timestamp, value))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def mean(self):
+        """
+            Return the mean of the values in the window
+
+            :return: The mean, or None if there is no value
+        """
+        if not self.samples:
+            return None
+        if self.mins[0][1] == self.maxs[0][1]:
+            return self.mins[0][1]
+        return self.shift + self.total / len(self.samples)
+
+    def variance(self):
+        """
+            Return the variance of the values in the window
+
+            :return: The variance, or None if there is no value
+        """
+        if not self.samples:
+            return None
+        if self.mins[0][1] == self.maxs[0][1]:
+            return 0.0
+        mean = self.total / len(self.samples)
+        return max(self.total_squares / len(self.samples) - mean * mean, 0.0)
+
+    def min(self):
+        """
+            Return the minimum value in the window
+
+            :return: The minimum value, or None if there is no value
+        """
+        if not self.mins:
+            return None
+        return self.mins[0][1]
+
+    def max(self):
+        """
+            Return the maximum value in the window
+
+            :return: The maximum value, or None if there is no value
+        """
+        if not self.maxs:
+            return None
+        return self.maxs[0][1]
+
+    def quantile(self, q):
+        """
+            Return an approximation of a quantile of the values in the window
+
+            The error is at most the width of a bin.
+
+            :param q: The quantile, between 0 and 1
+            :return: The upper bound of the bin holding the quantile,
+                     or None if there is no value
+        """
+        if not self.samples:
+            return None
+        rank = q * len(self.samples)
+        count = 0
+        for index, bin_count in enumerate(self.histogram):
+            count += bin_count
+            if count >= rank and bin_count:
+                width = (self.high - self.low) / self.bins
+                return self.low + (index + 1) * width
+        return self.high
+
+class Aggregator:
+    """
+        A class computing windowed statistics of sampled events
+
+        :param sampler: The Sampler object providing the event values
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.stats = {}
+        sampler.add_listener(self.add)
+
+    def watch(self, event, window, value_range=None, bins=200):
+        """
+            Compute statistics of an event over a sliding window
+
+            :param event: The PerfEvent object to watch
+            :param window: The length of the window, in seconds
+            :param value_range: A tuple of min and max value, for quantiles.
+                                By default, the range of the event. It must
+                                be given if the event has no range.
+            :param bins: The number of bins used to approximate quantiles
+            :return: A WindowedStats object
+        """
+        if value_range is None:
+            value_range = event.get_range()
+            if value_range[0] is None or value_range[1] is None:
+                raise ValueError("Event {} has no range, value_range must "
+                                 "be given".format(event.name))
+        stats = WindowedStats(window, value_range, bins)
+        self.stats.setdefault(event, []).append(stats)
+        return stats
+
+    def unwatch(self, event, stats):
+        """
+            Stop computing statistics
+
+            :param event: The PerfEvent object watched
+            :param stats: The WindowedStats object returned by watch()
+        """
+        self.stats[event].remove(stats)
+
+    def add(self, event, timestamp, value):
+        """
+            Update the statistics of an event with a new value
+
+            :param event: The PerfEvent object
+            :param timestamp: The time of the value, in seconds
+            :param value: The value of the event
+        """
+        for stats in self.stats.get(event, ()):
+            stats.add(timestamp, value)
+
+    def close(self):
+        """
+            Stop receiving values from the sampler
+        """
+        self.sampler.remove_listener(self.add)
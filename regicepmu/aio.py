@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to access the PMU from asyncio code.
+
+    The register accesses are blocking, so they are run in a thread owned by
+    the device, keeping the event loop free. A device has only one thread,
+    as the debug connection usually can't be used concurrently.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def get_executor(device):
+    """
+        Return the executor running the register accesses of a device
+
+        :param device: A Device object
+        :return: A ThreadPoolExecutor object, with one thread
+    """
+    executor = getattr(device, 'executor', None)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1)
+        device.executor = executor
+    return executor
+
+def _get_pending(device):
+    pending = getattr(device, 'pending_reads', None)
+    if pending is None:
+        pending = {}
+        device.pending_reads = pending
+    return pending
+
+async def run(device, key, function, *args):
+    """
+        Run a blocking function in the device executor
+
+        Concurrent calls using the same key share a single call of function.
+
+        :param device: A Device object
+        :param key: A key identifying the call
+        :param function: The function to run
+        :return: The value returned by function
+    """
+    pending = _get_pending(device)
+    future = pending.get(key)
+    if future is None:
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(get_executor(device), function, *args)
+        pending[key] = future
+        future.add_done_callback(lambda _: pending.pop(key, None))
+    return await asyncio.shield(future)
+
+async def _produce(perf, events, interval, queue):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time()
+    while True:
+        try:
+            values = await run(perf.device, ('values', id(perf), tuple(events)),
+                               perf.get_values, events)
+            await queue.put((time.monotonic(), values, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            await queue.put((None, None, err))
+            return
+        deadline += interval
+        await asyncio.sleep(max(deadline - loop.time(), 0))
+        deadline = max(deadline, loop.time())
+
+async def stream(perf, events, rate, maxsize=1):
+    """
+        Sample events periodically
+
+        Sampling waits when maxsize samples are waiting for the consumer,
+        so a slow consumer slows the sampling down instead of
+        accumulating samples.
+
+        :param perf: A Perf object
+        :param events: A list of PerfEvent objects
+        :param rate: The sampling rate, in Hz
+        :param maxsize: The number of samples that could wait for
+                        the consumer
+        :return: An asynchronous iterator of tuple of timestamp and
+                 a dictionary of values, indexed by PerfEvent object
+    """
+    queue = asyncio.Queue(maxsize)
+    producer = asyncio.ensure_future(_produce(perf, list(events), 1.0 / rate,
+                                              queue))
+    try:
+        while True:
+            timestamp, values, err = await queue.get()
+            if err is not None:
+                raise err
+            yield timestamp, values
+    finally:
+        producer.cancel()
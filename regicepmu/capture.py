@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to record counter samples in a binary capture file.
+
+    A capture starts with a header describing the PMU, its counters (with the
+    event each one was counting) and its events, followed by fixed-width
+    records. Each record is made of little-endian 64 bits words: the
+    timestamp in nanoseconds, then the value of each counter. The reader
+    maps the file in memory, and exposes the records as NumPy arrays
+    without copying them.
+"""
+
+import json
+import mmap
+import os
+import struct
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'RPMUCAP\0'
+VERSION = 1
+_PREAMBLE = struct.Struct('<8sII')
+
+class CaptureError(Exception):
+    """
+        Raised when a capture file is invalid
+    """
+
+def make_header(pmu, counter_names):
+    """
+        Return the metadata of a capture
+
+        :param pmu: The PMU object the counters belong to
+        :param counter_names: A list of counters' name recorded
+        :return: A dictionary, with the PMU name, counters and events
+    """
+    counters = []
+    for name in counter_names:
+        counter = pmu.counters[name]
+        event_id = counter.event_id if counter.support_event else None
+        counters.append({'name': name, 'width': counter.width,
+                         'event': event_id})
+    return {
+        'pmu': pmu.name,
+        'counters': counters,
+        'events': {str(event_id): list(event)
+                   for event_id, event in pmu.events.items()},
+    }
+
+class CaptureWriter:
+    """
+        A class to write a capture file
+
+        :param path: The path of the capture file
+        :param pmu: The PMU object the counters belong to
+        :param counter_names: A list of counters' name to record,
+                              by default all the PMU counters
+    """
+    def __init__(self, path, pmu, counter_names=None):
+        if counter_names is None:
+            counter_names = list(pmu.counters)
+        self.counter_names = list(counter_names)
+        self.record = struct.Struct('<{}Q'.format(len(self.counter_names) + 1))
+        self.count = 0
+        header = make_header(pmu, self.counter_names)
+        data = json.dumps(header).encode('utf-8')
+        data += b' ' * (-(len(data) + _PREAMBLE.size) % 8)
+        self.file = open(path, 'wb')
+        self.file.write(_PREAMBLE.pack(MAGIC, VERSION, len(data)))
+        self.file.write(data)
+
+    def write(self, timestamp, values):
+        """
+            Write a record
+
+            :param timestamp: The time of the record, in seconds
+            :param values: A list of counter values, in the order of
+                           counter_names
+        """
+        self.file.write(self.record.pack(int(round(timestamp * 1e9)), *values))
+        self.count += 1
+
+    def write_snapshot(self, snapshot):
+        """
+            Write a record from a snapshot
+
+            :param snapshot: A PMUSnapshot object holding the recorded counters
+        """
+        self.write(snapshot.timestamp,
+                   [snapshot[name] for name in self.counter_names])
+
+    def close(self):
+        """
+            Flush and close the capture file
+        """
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CaptureReader:
+    """
+        A class to read a capture file
+
+        The file is mapped in memory, so opening a capture doesn't read it.
+        The arrays returned by the reader are views on the mapping, and must
+        not be used after close().
+        :param path: The path of the capture file
+    """
+    def __init__(self, path):
+        if numpy is None:
+            raise ImportError("Reading captures requires NumPy")
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < _PREAMBLE.size:
+                raise CaptureError("{} is not a capture file".format(path))
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = _PREAMBLE.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            self.mmap.close()
+            raise CaptureError("{} is not a capture file".format(path))
+        offset = _PREAMBLE.size + length
+        header = json.loads(self.mmap[_PREAMBLE.size:offset].decode('utf-8'))
+        self.pmu_name = header['pmu']
+        self.counters = header['counters']
+        self.counter_names = [counter['name'] for counter in self.counters]
+        self.events = {int(event_id): event
+                       for event_id, event in header['events'].items()}
+        width = len(self.counters) + 1
+        count = (len(self.mmap) - offset) // (width * 8)
+        self.records = numpy.frombuffer(self.mmap, dtype='<u8',
+                                        count=count * width, offset=offset)
+        self.records = self.records.reshape(count, width)
+        self.timestamps = self.records[:, 0]
+
+    def __len__(self):
+        return len(self.records)
+
+    def counter(self, counter_name, records=None):
+        """
+            Return the values of a counter
+
+            :param counter_name: The name of the counter
+            :param records: The records to use, by default all the records
+            :return: A NumPy view of the counter values
+        """
+        if records is None:
+            records = self.records
+        return records[:, self.counter_names.index(counter_name) + 1]
+
+    def time_slice(self, start=None, end=None):
+        """
+            Return the records in a time range
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range (excluded), in seconds
+            :return: A NumPy view of the records
+        """
+        first = 0
+        last = len(self.records)
+        if start is not None:
+            first = numpy.searchsorted(self.timestamps, int(round(start * 1e9)))
+        if end is not None:
+            last = numpy.searchsorted(self.timestamps, int(round(end * 1e9)))
+        return self.records[first:last]
+
+    def close(self):
+        """
+            Unmap the capture file
+
+            If views returned by the reader are still referenced, the
+            mapping can't be closed: a warning is issued, and the mapping
+            is released with the last view.
+        """
+        self.records = None
+        self.timestamps = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            warnings.warn("Capture views are still in use, the capture file "
+                          "stays mapped until they are released")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to sample many devices concurrently.
+
+    Each device is sampled by its own worker thread, on a time base shared
+    by all the devices. A device that fails or hangs doesn't delay the
+    others: its ticks are reported as missed until it is ready again.
+"""
+
+import queue
+import threading
+import time
+
+from regicepmu.periodic import PeriodicThread
+
+class DeviceWorker:
+    """
+        A thread sampling the events of one device
+
+        :param name: The name of the device
+        :param perf: The Perf object of the device
+        :param events: A list of PerfEvent objects to sample, if None all
+                       the enabled events are sampled
+        :param output: The queue to put samples to
+    """
+    def __init__(self, name, perf, events, output):
+        self.name = name
+        self.perf = perf
+        self.events = events
+        self.output = output
+        self.requests = queue.Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        self.busy = False
+        self.errors = 0
+        self.missed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _get_events(self):
+        if self.events is not None:
+            return self.events
+        return [event for event in self.perf.get_events() if event.enabled()]
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            timestamp = self.requests.get()
+            if timestamp is None:
+                return
+            try:
+                values = self.perf.get_values(self._get_events())
+                values = {event.name: value for event, value in values.items()}
+                sample = (timestamp, self.name, values, None)
+            except Exception as err:
+                self.errors += 1
+                sample = (timestamp, self.name, None, err)
+            self.busy = False
+            self.output.put(sample)
+
+    def request(self, timestamp):
+        """
+            Ask the worker to take a sample
+
+            :param timestamp: The time of the tick
+            :return: False if the worker is still busy with a previous
+                     sample, True otherwise
+        """
+        if self.busy:
+            self.missed += 1
+            return False
+        self.busy = True
+        self.requests.put(timestamp)
+        return True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+            Stop the worker, once the current sample is done
+
+            If a request is already queued, there is no room for the stop
+            request: the worker then stops once that request is done.
+
+            :param timeout: How long to wait for the thread, in seconds
+        """
+        self.stop_event.set()
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+class Collector:
+    """
+        A class to sample many devices concurrently
+
+        Samples of all the devices are merged in one queue, as tuples of
+        tick timestamp, device name, a dictionary of values indexed by
+        event name, and the exception raised by the device (or None).
+        :param perfs: A dictionary of Perf objects, indexed by device name
+        :param rate: The sampling rate, in Hz
+        :param events: A dictionary of lists of PerfEvent objects to sample,
+                       indexed by device name. By default, all the enabled
+                       events are sampled.
+        :param clock: A function returning the current time, in seconds
+    """
+    def __init__(self, perfs, rate=10.0, events=None, clock=time.monotonic):
+        self.interval = 1.0 / rate
+        self.clock = clock
+        self.samples = queue.Queue()
+        self.workers = {}
+        for name, perf in perfs.items():
+            device_events = (events or {}).get(name)
+            self.workers[name] = DeviceWorker(name, perf, device_events,
+                                              self.samples)
+        self.periodic = PeriodicThread(self.tick, lambda: self.interval,
+                                       clock)
+
+    def tick(self, timestamp=None):
+        """
+            Ask every device to take a sample
+
+            :param timestamp: The time of the tick, by default the current time
+            :return: A list of the devices' name that missed the tick
+        """
+        if timestamp is None:
+            timestamp = self.clock()
+        return [name for name, worker in self.workers.items()
+                if not worker.request(timestamp)]
+
+    def get(self, timeout=None):
+        """
+            Return the next sample
+
+            :param timeout: How long to wait for a sample, in seconds
+            :return: A tuple of timestamp, device name, values and error,
+                     or None on timeout
+        """
+        try:
+            return self.samples.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_status(self):
+        """
+            Return the status of each device
+
+            :return: A dictionary of tuple of busy flag, errors count and
+                     missed ticks count, indexed by device name
+        """
+        return {name: (worker.busy, worker.errors, worker.missed)
+                for name, worker in self.workers.items()}
+
+    def start(self, periodic=True):
+        """
+            Start the workers, and the periodic sampling
+
+            :param periodic: If False, only start the workers, samples are
+                             then requested with tick()
+        """
+        for worker in self.workers.values():
+            worker.start()
+        if periodic:
+            self.periodic.start()
+
+    def stop(self, timeout=1.0):
+        """
+            Stop the sampling and the workers
+
+            Workers stuck on a hung device are abandoned after timeout.
+
+            :param timeout: How long to wait for each worker, in seconds
+        """
+        self.periodic.stop()
+        for worker in self.workers.values():
+            worker.stop(timeout)
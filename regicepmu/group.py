@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to manage the PMUs of many cores as a single one.
+
+    The counters of all the cores are read together: either merged into
+    as few block reads as possible, or read by one thread per core if the
+    debug connection supports concurrent accesses. System-wide events are
+    computed from the per-core events, using a single read of each counter.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+from regicepmu.perf import Perf, PerfEvent
+from regicepmu.pmu import PMU, PMUSnapshot
+
+class PMUGroup(PMU):
+    """
+        A PMU owning the PMUs of many cores
+
+        The group has no counter of its own. Enabling the group enables
+        every core PMU, and a read tick of the group is a read tick of every
+        core PMU.
+        :param device: A Device object (e.g the owner of the PMU)
+        :param name: The name of the PMU, also used as PMU id
+        :param pmus: A list of PMU objects, one per core
+        :param parallel: If True, the core PMUs are read concurrently, one
+                         thread per core. This must only be used if the
+                         regice client supports concurrent accesses.
+    """
+    def __init__(self, device, name, pmus, parallel=False):
+        for pmu in pmus:
+            if pmu.device is not device:
+                raise ValueError("PMU {} doesn't belong to the device of {}"
+                                 .format(pmu.name, name))
+        super(PMUGroup, self).__init__(device, name)
+        self.pmus = list(pmus)
+        self.parallel = parallel
+        self.executor = None
+
+    def _enable(self):
+        for pmu in self.pmus:
+            pmu.enable(refcount=True)
+
+    def _disable(self):
+        for pmu in self.pmus:
+            pmu.disable(refcount=True)
+
+    def _enabled(self):
+        return all(pmu.enabled() for pmu in self.pmus)
+
+    def pause(self):
+        for pmu in self.pmus:
+            pmu.pause()
+
+    def resume(self):
+        for pmu in self.pmus:
+            pmu.resume()
+
+    def reset(self):
+        for pmu in self.pmus:
+            pmu.reset()
+
+    @contextmanager
+    def tick(self, ttl=None, cache=None):
+        """
+            Run a with block within a read tick of the group
+
+            :param ttl: If set, cached values older than ttl seconds are
+                        read again from the hardware
+            :param cache: A ReadCache object to use, shared by the group
+                          and every core PMU. By default, a new one each.
+        """
+        with ExitStack() as stack:
+            stack.enter_context(super(PMUGroup, self).tick(ttl, cache))
+            for pmu in self.pmus:
+                stack.enter_context(pmu.tick(ttl, cache))
+            yield self
+
+    def get_core_events(self, event_type):
+        """
+            Return the events of the core PMUs
+
+            :param event_type: The type of event to return
+            :return: A list of PerfEvent objects, in the order of the cores
+        """
+        events = []
+        for pmu in self.pmus:
+            events.extend(pmu.perf_events.get(event_type, {}).values())
+        return events
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.pmus))
+        return self.executor
+
+    @staticmethod
+    def _snapshot_core(pmu, counter_names, cache):
+        if cache is None:
+            return pmu.snapshot(counter_names)
+        with pmu.tick(cache=cache):
+            return pmu.snapshot(counter_names)
+
+    def _snapshot_parallel(self, counter_names):
+        executor = self._get_executor()
+        futures = [(pmu, executor.submit(self._snapshot_core, pmu,
+                                         counter_names(pmu), pmu.read_cache))
+                   for pmu in self.pmus]
+        return {pmu.name: future.result() for pmu, future in futures}
+
+    def _snapshot_merged(self, counter_names):
+        values = {pmu: {} for pmu in self.pmus}
+        pending = []
+        for pmu in self.pmus:
+            for counter in pmu._snapshot_counters(counter_names(pmu)):
+                value = pmu.cache_lookup(counter)
+                if value is None:
+                    pending.append(counter)
+                else:
+                    values[pmu][counter.register.name] = value
+        blocks = self._plan_reads(pending)
+        timestamp = time.monotonic()
+        for counter, value in self._read_counters(blocks).items():
+            values[counter.pmu][counter.register.name] = value
+        return {pmu.name: PMUSnapshot(pmu, pmu_values, timestamp,
+                                      virtual_values=pmu._virtual_values(
+                                          pmu_values))
+                for pmu, pmu_values in values.items()}
+
+    def snapshot_all(self, counter_names=None):
+        """
+            Read the counters of every core PMU in one pass
+
+            :param counter_names: A dictionary of lists of counters' name,
+                                  indexed by core PMU name. Core PMUs missing
+                                  from it are not read. If None, all the
+                                  enabled counters of every core are read.
+            :return: A dictionary of PMUSnapshot objects, indexed by core
+                     PMU name
+        """
+        if counter_names is None:
+            names = lambda pmu: None
+        else:
+            names = lambda pmu: counter_names.get(pmu.name, [])
+        if self.parallel:
+            return self._snapshot_parallel(names)
+        return self._snapshot_merged(names)
+
+    def get_values(self, events):
+        """
+            Get the value of many events of the core PMUs
+
+            The counters of all the events are read with one snapshot,
+            then the events are computed from the read cache.
+
+            :param events: A list of PerfEvent objects of the core PMUs
+            :return: A dictionary of values, indexed by PerfEvent object
+        """
+        counter_names = {}
+        for event in events:
+            for counter in event.get_counters():
+                names = counter_names.setdefault(counter.pmu.name, [])
+                if counter.register.name not in names:
+                    names.append(counter.register.name)
+        with self.tick():
+            self.snapshot_all(counter_names)
+            return {event: event.get_value() for event in events}
+
+    def close(self):
+        """
+            Stop the threads used to read the core PMUs concurrently
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+class SystemLoad(PerfEvent):
+    """
+        The mean load of all the cores of a PMUGroup
+
+        :param group: The PMUGroup object
+        :param events: The per-core load events. By default, the CPU load
+                       events of the core PMUs.
+    """
+    def __init__(self, group, events=None):
+        super(SystemLoad, self).__init__(group, Perf.SYSTEM_LOAD,
+                                         "System load")
+        if events is None:
+            events = group.get_core_events(Perf.CPU_LOAD)
+        self.events = list(events)
+        for event in self.events:
+            self.counters.extend(event.get_counters())
+        self.yrange = [0, 100]
+        self.unit = '%'
+
+    def _enable(self):
+        for event in self.events:
+            event.enable()
+
+    def _disable(self):
+        for event in self.events:
+            event.disable()
+
+    def get_core_values(self):
+        """
+            Return the load of each core, from one read of the counters
+
+            :return: A dictionary of values, indexed by per-core PerfEvent
+        """
+        return self.pmu.get_values(self.events)
+
+    def get_value(self):
+        values = [value for value in self.get_core_values().values()
+                  if value is not None]
+        if not values:
+            return None
+        return sum(values) / len(values)
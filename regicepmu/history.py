@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to keep a downsampled history of event values, for plotting.
+
+    Values are aggregated as they arrive in buckets of increasing duration,
+    one level per resolution. A query picks a level covering the whole
+    requested time range with a bounded number of points, so plotting a
+    long capture doesn't have to go through every sample.
+"""
+
+import bisect
+import math
+from collections import deque
+
+class HistoryLevel:
+    """
+        The buckets of one resolution
+
+        Each bucket is a list of start time, min, max, sum and count.
+        :param duration: The duration of a bucket, in seconds
+        :param capacity: The maximum number of buckets kept
+    """
+    def __init__(self, duration, capacity):
+        self.duration = duration
+        self.starts = deque(maxlen=capacity)
+        self.buckets = deque(maxlen=capacity)
+
+    def add(self, timestamp, value):
+        """
+            Add a value to the bucket holding timestamp
+
+            :param timestamp: The time of the value, in seconds
+            :param value: The value
+        """
+        start = math.floor(timestamp / self.duration) * self.duration
+        if self.starts and self.starts[-1] == start:
+            bucket = self.buckets[-1]
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += value
+            bucket[4] += 1
+        else:
+            self.starts.append(start)
+            self.buckets.append([start, value, value, value, 1])
+
+    def range(self, start, end):
+        """
+            Return the indexes of the buckets between start and end
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range, in seconds
+            :return: A tuple of first index, and index after the last one
+        """
+        first = bisect.bisect_left(self.starts, start - self.duration)
+        if first < len(self.starts) and \
+           self.starts[first] + self.duration <= start:
+            first += 1
+        return first, bisect.bisect_right(self.starts, end)
+
+    def covers(self, start):
+        """
+            Return True if no bucket after start has been dropped
+
+            :param start: The start of the range, in seconds
+            :return: True if the buckets kept cover start
+        """
+        return len(self.starts) < self.starts.maxlen or \
+            self.starts[0] <= start
+
+    def get(self, start, end):
+        """
+            Return the buckets between start and end
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range, in seconds
+            :return: A list of tuple of start time, min, max and mean value
+        """
+        first, last = self.range(start, end)
+        return [(bucket[0], bucket[1], bucket[2], bucket[3] / bucket[4])
+                for bucket in (self.buckets[i] for i in range(first, last))]
+
+def lttb(points, threshold):
+    """
+        Decimate points with the Largest-Triangle-Three-Buckets algorithm
+
+        The first and the last points are always kept, if threshold
+        allows it: a threshold of 2 returns them, and a threshold of 1
+        only returns the first one.
+
+        :param points: A list of tuple of x and y values, sorted by x
+        :param threshold: The number of points to return
+        :return: A list of at most threshold points, keeping the shape of
+                 the original ones
+    """
+    count = len(points)
+    if threshold >= count:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:max(threshold, 0)]
+
+    sampled = [points[0]]
+    every = (count - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, count)
+        avg_x = 0.0
+        avg_y = 0.0
+        for x, y in points[avg_start:avg_end]:
+            avg_x += x
+            avg_y += y
+        avg_x /= avg_end - avg_start
+        avg_y /= avg_end - avg_start
+
+        ax, ay = points[a]
+        best = -1.0
+        next_a = a
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best:
+                best = area
+                next_a = j
+        sampled.append(points[next_a])
+        a = next_a
+    sampled.append(points[-1])
+    return sampled
+
+class History:
+    """
+        A multi-resolution history of the values of an event
+
+        Level 0 keeps the raw values, each next level uses buckets factor
+        times longer than the previous one.
+        :param resolution: The duration of the buckets of level 1, in seconds
+        :param factor: The ratio between durations of two successive levels
+        :param levels: The number of levels of buckets
+        :param capacity: The maximum number of values or buckets per level
+    """
+    def __init__(self, resolution=1.0, factor=10, levels=4, capacity=4096):
+        self.capacity = capacity
+        self.timestamps = deque(maxlen=capacity)
+        self.values = deque(maxlen=capacity)
+        self.levels = [HistoryLevel(resolution * factor ** i, capacity)
+                       for i in range(levels)]
+
+    def add(self, timestamp, value):
+        """
+            Add a value to every level
+
+            :param timestamp: The time of the value, in seconds
+            :param value: The value, ignored if None or NaN
+        """
+        if value is None or math.isnan(value):
+            return
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        for level in self.levels:
+            level.add(timestamp, value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _raw(self, start, end):
+        first = bisect.bisect_left(self.timestamps, start)
+        last = bisect.bisect_right(self.timestamps, end)
+        return first, last
+
+    def _candidates(self, start, end):
+        """
+            Return the levels covering start, from the finest one
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range, in seconds
+            :return: A list of tuple of level (None for the raw values)
+                     and number of points between start and end
+        """
+        candidates = []
+        if len(self.timestamps) < self.capacity or \
+           self.timestamps[0] <= start:
+            first, last = self._raw(start, end)
+            candidates.append((None, last - first))
+        for level in self.levels:
+            if level.covers(start):
+                first, last = level.range(start, end)
+                candidates.append((level, last - first))
+        return candidates
+
+    def _select(self, start, end, max_points):
+        for level, count in self._candidates(start, end):
+            if count <= max_points:
+                return level
+        return self.levels[-1]
+
+    def _get(self, level, start, end):
+        if level is None:
+            first, last = self._raw(start, end)
+            return [(self.timestamps[i], self.values[i], self.values[i],
+                     self.values[i]) for i in range(first, last)]
+        return level.get(start, end)
+
+    def envelope(self, start, end, max_points):
+        """
+            Return the min, max and mean values between start and end
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range, in seconds
+            :param max_points: The maximum number of points to return, if
+                               the history is long enough to provide it
+            :return: A list of tuple of time, min, max and mean value
+        """
+        return self._get(self._select(start, end, max_points), start, end)
+
+    def query(self, start, end, width):
+        """
+            Return the values to plot between start and end
+
+            This uses the coarsest level still giving width points, then
+            decimates them down to width points. If no level gives width
+            points, the finest level is used as is.
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range, in seconds
+            :param width: The width of the plot, in pixels
+            :return: A list of at most width tuple of time and value
+        """
+        candidates = self._candidates(start, end)
+        if candidates:
+            selected = candidates[0][0]
+        else:
+            selected = self.levels[-1]
+        for level, count in candidates:
+            if count < width:
+                break
+            selected = level
+        points = [(bucket[0], bucket[3])
+                  for bucket in self._get(selected, start, end)]
+        return lttb(points, width)
+
+class HistoryRecorder:
+    """
+        A class keeping the history of sampled events
+
+        :param sampler: The Sampler object providing the event values
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.histories = {}
+        sampler.add_listener(self.add)
+
+    def watch(self, event, **kwargs):
+        """
+            Keep the history of an event
+
+            :param event: The PerfEvent object to watch
+            :param kwargs: The arguments of History
+            :return: A History object
+        """
+        history = self.histories.get(event)
+        if history is None:
+            history = History(**kwargs)
+            self.histories[event] = history
+        return history
+
+    def unwatch(self, event):
+        """
+            Stop keeping the history of an event
+
+            :param event: The PerfEvent object watched
+        """
+        self.histories.pop(event, None)
+
+    def add(self, event, timestamp, value):
+        """
+            Update the history of an event with a new value
+
+            :param event: The PerfEvent object
+            :param timestamp: The time of the value, in seconds
+            :param value: The value of the event
+        """
+        history = self.histories.get(event)
+        if history is not None:
+            history.add(timestamp, value)
+
+    def close(self):
+        """
+            Stop receiving values from the sampler
+        """
+        self.sampler.remove_listener(self.add)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to record statistics of the register accesses.
+
+    Instrumentation replaces the methods of a PMU and its counters by
+    wrappers measuring them, so there is no cost at all when it is disabled.
+    The bytes of an operation are the bytes actually transferred by the
+    regice client during the call: a counter read served by the read cache
+    is recorded as a cache hit, and block reads are recorded on their own.
+"""
+
+import sys
+import threading
+import time
+
+HISTOGRAM_BUCKETS = 32
+PMU_OPERATIONS = ('enable', 'disable', 'pause', 'resume', 'reset')
+COUNTER_OPERATIONS = ('enable', 'disable', 'set_event')
+TRANSPORT_OPERATIONS = ('read', 'write', 'read_block')
+_MISSING = object()
+
+class TransportStats:
+    """
+        A class counting the bytes transferred by a regice client
+
+        The client belongs to the whole device, so it is instrumented once,
+        whatever the number of PMUs recording statistics, and restored
+        when the last of them releases it.
+        Nested calls (e.g a block read implemented with single reads)
+        are only counted once.
+        :param client: The regice client to instrument
+    """
+    lock = threading.Lock()
+    clients = {}
+
+    def __init__(self, client):
+        self.client = client
+        self.local = threading.local()
+        self.users = 0
+        self.saved = {}
+
+    @classmethod
+    def acquire(cls, client):
+        """
+            Return the TransportStats of a client, instrumenting it if needed
+
+            :param client: The regice client
+            :return: A TransportStats object, to release once done
+        """
+        with cls.lock:
+            transport = cls.clients.get(id(client))
+            if transport is None:
+                transport = TransportStats(client)
+                transport._instrument()
+                cls.clients[id(client)] = transport
+            transport.users += 1
+            return transport
+
+    def release(self):
+        """
+            Stop using the statistics, restoring the client with the last user
+        """
+        with self.lock:
+            self.users -= 1
+            if self.users:
+                return
+            del self.clients[id(self.client)]
+            for operation, method in self.saved.items():
+                if method is _MISSING:
+                    self.client.__dict__.pop(operation, None)
+                else:
+                    setattr(self.client, operation, method)
+
+    def transferred(self):
+        """
+            Return the number of bytes transferred by the current thread
+
+            :return: A number of bytes
+        """
+        return getattr(self.local, 'bytes', 0)
+
+    def _wrap(self, operation):
+        method = getattr(self.client, operation)
+        local = self.local
+
+        def wrapper(width, address, *args):
+            depth = getattr(local, 'depth', 0)
+            local.depth = depth + 1
+            try:
+                return method(width, address, *args)
+            finally:
+                local.depth = depth
+                if depth == 0:
+                    count = args[0] if operation == 'read_block' else 1
+                    local.bytes = getattr(local, 'bytes', 0) + \
+                        count * max(width // 8, 1)
+        self.saved[operation] = self.client.__dict__.get(operation, _MISSING)
+        setattr(self.client, operation, wrapper)
+
+    def _instrument(self):
+        for operation in TRANSPORT_OPERATIONS:
+            if hasattr(self.client, operation):
+                self._wrap(operation)
+
+class OperationStats:
+    """
+        The statistics of one operation
+
+        The latency histogram uses power of two buckets, in microseconds:
+        bucket n counts the calls that took less than 2^n us.
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, elapsed, size):
+        """
+            Account a call
+
+            :param elapsed: The duration of the call, in seconds
+            :param size: The number of bytes transferred by the call
+        """
+        self.count += 1
+        self.bytes += size
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        bucket = min(int(elapsed * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def to_dict(self):
+        """
+            Return the statistics as a dictionary
+
+            :return: A dictionary of statistics
+        """
+        return {
+            'count': self.count,
+            'bytes': self.bytes,
+            'total_time': self.total_time,
+            'mean_time': self.total_time / self.count if self.count else 0.0,
+            'max_time': self.max_time,
+            'histogram': list(self.histogram),
+        }
+
+class PMUStats:
+    """
+        A class to record the statistics of a PMU and its counters
+
+        :param pmu: The PMU object to instrument
+        :param caller: If True, statistics are also split by caller
+    """
+    def __init__(self, pmu, caller=False):
+        self.pmu = pmu
+        self.caller = caller
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.transport = None
+
+    def record(self, target, operation, elapsed, size):
+        """
+            Record a call
+
+            :param target: The name of the PMU or counter
+            :param operation: The name of the operation
+            :param elapsed: The duration of the call, in seconds
+            :param size: The number of bytes transferred by the call
+        """
+        caller = None
+        if self.caller:
+            frame = sys._getframe(2)
+            caller = "{}:{}".format(frame.f_code.co_filename,
+                                    frame.f_code.co_name)
+        key = (target, operation, caller)
+        with self.lock:
+            stats = self.operations.get(key)
+            if stats is None:
+                stats = OperationStats()
+                self.operations[key] = stats
+            stats.add(elapsed, size)
+
+    def _transferred(self):
+        if self.transport is None:
+            return 0
+        return self.transport.transferred()
+
+    def _wrap(self, obj, method_name, target, operation=None):
+        method = getattr(obj, method_name)
+        record = self.record
+        transferred = self._transferred
+
+        def wrapper(*args, **kwargs):
+            name = operation() if operation else method_name
+            if name is None:
+                return method(*args, **kwargs)
+            size = transferred()
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                record(target(), name, time.perf_counter() - start,
+                       transferred() - size)
+        setattr(obj, method_name, wrapper)
+
+    def instrument_transport(self):
+        """
+            Count the bytes transferred by the regice client of the PMU
+        """
+        if self.transport is None:
+            self.transport = TransportStats.acquire(self.pmu.device.client)
+
+    def instrument_pmu(self):
+        """
+            Instrument the PMU control operations and block reads
+        """
+        for operation in PMU_OPERATIONS:
+            self._wrap(self.pmu, operation, lambda: self.pmu.name)
+        self._wrap(self.pmu, '_read_block', lambda: self.pmu.name,
+                   lambda: 'read_block')
+
+    def instrument_counter(self, counter):
+        """
+            Instrument the operations of a counter
+
+            Reads of the register are recorded as 'read', reads served
+            by the read cache are recorded as 'cache_hit'.
+            :param counter: The PMUCounter object to instrument
+        """
+        target = lambda: counter.register.name
+        for operation in COUNTER_OPERATIONS:
+            self._wrap(counter, operation, target)
+        self._wrap(counter, 'read_raw', target, lambda: 'read')
+
+        def read_operation():
+            cache = counter.pmu.read_cache
+            if cache is not None and cache.lookup(counter) is not None:
+                return 'cache_hit'
+            return None
+        self._wrap(counter, 'read', target, read_operation)
+
+    def uninstrument(self):
+        """
+            Restore the methods of the PMU, its counters and regice client
+        """
+        for operation in PMU_OPERATIONS + ('_read_block',):
+            self.pmu.__dict__.pop(operation, None)
+        for counter in self.pmu.counters.values():
+            for operation in COUNTER_OPERATIONS + ('read', 'read_raw'):
+                counter.__dict__.pop(operation, None)
+        if self.transport is not None:
+            self.transport.release()
+            self.transport = None
+
+    def get(self):
+        """
+            Return the statistics
+
+            :return: A dictionary of statistics, indexed by a tuple of
+                     target name, operation and caller (None if statistics
+                     are not split by caller)
+        """
+        with self.lock:
+            return {key: stats.to_dict()
+                    for key, stats in self.operations.items()}
+
+    def reset(self):
+        """
+            Drop all the recorded statistics
+        """
+        with self.lock:
+            self.operations = {}
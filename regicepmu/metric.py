@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to define derived metrics as expressions over PMU counters.
+
+    A metric is an arithmetic expression, such as
+    "100 * (cycles - idle_cycles) / cycles", where names refer to a counter
+    name, to the name of an event assigned to a counter, or to an event id
+    written as event_<id>. Expressions are compiled once, and all the metrics
+    of a MetricSet are evaluated against a single snapshot.
+"""
+
+import ast
+import sys
+
+from regicepmu.perf import PerfEvent
+
+class MetricError(Exception):
+    """
+        Raised when a metric expression is invalid or can't be evaluated
+    """
+
+_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+              ast.USub, ast.UAdd)
+_FUNCTIONS = {'min': min, 'max': max, 'abs': abs}
+
+# Before Python 3.8, numbers are parsed as ast.Num
+if sys.version_info < (3, 8):
+    _CONSTANTS = (ast.Constant, ast.Num)
+else:
+    _CONSTANTS = (ast.Constant,)
+
+def _constant_value(node):
+    if isinstance(node, ast.Constant):
+        return node.value
+    return node.n
+
+class Metric:
+    """
+        A compiled metric expression
+
+        :param name: The name of the metric
+        :param expression: The expression of the metric
+    """
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as err:
+            raise MetricError("Invalid metric {}: {}".format(name, err))
+        self.names = set()
+        self._check(tree.body)
+        self.code = compile(tree, '<metric {}>'.format(name), 'eval')
+
+    def _check(self, node):
+        if isinstance(node, ast.BinOp):
+            self._check_operator(node.op)
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp):
+            self._check_operator(node.op)
+            self._check(node.operand)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or \
+               node.func.id not in _FUNCTIONS or node.keywords:
+                raise MetricError("Invalid call in metric {}".
+                                  format(self.name))
+            for arg in node.args:
+                self._check(arg)
+        elif isinstance(node, ast.Name):
+            self.names.add(node.id)
+        elif isinstance(node, _CONSTANTS):
+            if not isinstance(_constant_value(node), (int, float)):
+                raise MetricError("Invalid constant in metric {}".
+                                  format(self.name))
+        else:
+            raise MetricError("Invalid expression in metric {}".
+                              format(self.name))
+
+    def _check_operator(self, operator):
+        if not isinstance(operator, _OPERATORS):
+            raise MetricError("Invalid operator in metric {}".
+                              format(self.name))
+
+    def evaluate(self, values):
+        """
+            Evaluate the metric
+
+            :param values: A dictionary of values, indexed by name
+            :return: The value of the metric, or None if the metric
+                     divides by zero
+        """
+        scope = dict(_FUNCTIONS)
+        scope.update(values)
+        try:
+            return eval(self.code, {'__builtins__': {}}, scope)
+        except ZeroDivisionError:
+            return None
+
+class MetricSet:
+    """
+        A set of metrics evaluated against a single snapshot
+
+        :param pmu: The PMU object owning the counters
+        :param metrics: A dictionary of expressions, indexed by metric name
+        :param delta: If True, the metrics are evaluated on the difference
+                      between the current and the previous counter values,
+                      instead of the counter values
+    """
+    def __init__(self, pmu, metrics=None, delta=False):
+        self.pmu = pmu
+        self.delta = delta
+        self.metrics = {}
+        self.names = set()
+        self.previous = {}
+        for name, expression in (metrics or {}).items():
+            self.add(name, expression)
+
+    def add(self, name, expression):
+        """
+            Compile and add a metric
+
+            :param name: The name of the metric
+            :param expression: The expression of the metric
+            :return: The Metric object
+        """
+        metric = Metric(name, expression)
+        self.metrics[name] = metric
+        self.names |= metric.names
+        return metric
+
+    def _resolve(self, names):
+        events = {}
+        for counter in self.pmu.counters.values():
+            if counter.support_event and counter.allocated and \
+               counter.event_id is not None:
+                events['event_{}'.format(counter.event_id)] = counter
+                events[self.pmu.events[counter.event_id][0]] = counter
+        resolved = {}
+        for name in names:
+            if name in self.pmu.counters:
+                resolved[name] = name
+            elif name in events:
+                resolved[name] = events[name].register.name
+            else:
+                raise MetricError("Unknown counter or event {}".format(name))
+        return resolved
+
+    def get_counters(self, names=None):
+        """
+            Return the minimal set of counters needed by the metrics
+
+            :param names: A list of metrics' name, by default all the metrics
+            :return: A list of PMUCounter objects
+        """
+        resolved = self._resolve(self._names(names))
+        return [self.pmu.counters[name]
+                for name in sorted(set(resolved.values()))]
+
+    def _names(self, names):
+        if names is None:
+            return self.names
+        used = set()
+        for name in names:
+            used |= self.metrics[name].names
+        return used
+
+    def evaluate(self, names=None, snapshot=None):
+        """
+            Evaluate the metrics
+
+            The counters used by the metrics are read in one pass.
+
+            :param names: A list of metrics' name, by default all the metrics
+            :param snapshot: A PMUSnapshot to use instead of reading the
+                             counters
+            :return: A dictionary of metric values, indexed by metric name
+        """
+        resolved = self._resolve(self._names(names))
+        if snapshot is None:
+            snapshot = self.pmu.snapshot(sorted(set(resolved.values())))
+        if self.delta:
+            current = {name: snapshot.read_virtual(counter)
+                       for name, counter in resolved.items()}
+            key = tuple(sorted(names or self.metrics))
+            previous = self.previous.get(key)
+            self.previous[key] = current
+            if previous is None:
+                return {name: None for name in names or self.metrics}
+            values = {name: current[name] - previous[name]
+                      for name in current}
+        else:
+            values = {name: snapshot.read(counter)
+                      for name, counter in resolved.items()}
+        return {name: self.metrics[name].evaluate(values)
+                for name in names or self.metrics}
+
+class MetricEvent(PerfEvent):
+    """
+        A PerfEvent computed from a metric expression
+
+        :param metric_set: The MetricSet to add the metric to
+        :param perf_type: The type of the event
+        :param name: The name of the event, also used as metric name
+        :param expression: The expression of the metric
+    """
+    def __init__(self, metric_set, perf_type, name, expression):
+        super(MetricEvent, self).__init__(metric_set.pmu, perf_type, name)
+        self.metric_set = metric_set
+        self.metric = metric_set.add(name, expression)
+
+    def get_counters(self):
+        return self.metric_set.get_counters([self.name])
+
+    def get_value(self):
+        return self.metric_set.evaluate([self.name])[self.name]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to count more events than the PMU has counters.
+
+    Events are gathered in groups, and groups are scheduled on the counters
+    in round-robin. The counts are then scaled by the ratio of the time
+    the events were enabled to the time they were actually counted.
+"""
+
+import math
+import time
+
+from regicepmu.pmu import CounterAllocationError
+
+class MultiplexedEvent:
+    """
+        The counting state of one multiplexed event
+
+        :param event_id: The id of the event
+    """
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.count = 0
+        self.time_enabled = 0.0
+        self.time_running = 0.0
+        self.slices = 0
+        self.mean_rate = 0.0
+        self.rate_m2 = 0.0
+
+    def add_slice(self, count, duration):
+        """
+            Account a time slice the event has been counted
+
+            :param count: The count of the event during the slice
+            :param duration: The duration of the slice, in seconds
+        """
+        self.count += count
+        self.time_running += duration
+        if duration <= 0:
+            return
+        rate = count / duration
+        self.slices += 1
+        delta = rate - self.mean_rate
+        self.mean_rate += delta / self.slices
+        self.rate_m2 += delta * (rate - self.mean_rate)
+
+    def scaled(self):
+        """
+            Return the scaled estimate of the event count
+
+            The error is one standard deviation of the rates measured
+            in each slice, over the time the event was not counted.
+
+            :return: A tuple of estimated count and error, or (None, None)
+                     if the event has never been counted
+        """
+        if self.time_running <= 0:
+            return None, None
+        estimate = self.count * self.time_enabled / self.time_running
+        if self.slices < 2:
+            return estimate, estimate - self.count
+        stddev = math.sqrt(self.rate_m2 / (self.slices - 1))
+        return estimate, stddev * (self.time_enabled - self.time_running)
+
+class Multiplexer:
+    """
+        A class to time-slice groups of events over the PMU counters
+
+        Events of a group are always counted together. rotate() must be
+        called periodically to switch to the next groups.
+        :param pmu: A PMU object
+        :param groups: A list of groups, each group being a list of
+                       events' id, or a single event id
+        :param clock: A function returning the current time, in seconds
+    """
+    def __init__(self, pmu, groups, clock=time.monotonic):
+        self.pmu = pmu
+        self.groups = [group if isinstance(group, (list, tuple)) else [group]
+                       for group in groups]
+        self.clock = clock
+        self.events = {}
+        for group in self.groups:
+            for event_id in group:
+                self.events[event_id] = MultiplexedEvent(event_id)
+        self.position = 0
+        self.running = []
+        self.last_time = None
+
+    def _schedule(self):
+        self.running = []
+        scheduled = 0
+        for i in range(len(self.groups)):
+            index = (self.position + i) % len(self.groups)
+            group = self.groups[index]
+            try:
+                counters = self.pmu.enable_events(group)
+            except CounterAllocationError:
+                break
+            for counter, event_id in zip(counters, group):
+                self.running.append((counter, event_id, counter.read()))
+            scheduled += 1
+        if not scheduled:
+            raise CounterAllocationError("Can't schedule group {}".
+                                         format(self.groups[self.position]))
+        self.position = (self.position + scheduled) % len(self.groups)
+
+    def _unschedule(self, now):
+        duration = now - self.last_time
+        for event in self.events.values():
+            event.time_enabled += duration
+        for counter, event_id, start in self.running:
+            count = (counter.read() - start) & counter.mask
+            self.events[event_id].add_slice(count, duration)
+            self.pmu.disable_event(counter)
+        self.running = []
+
+    def start(self):
+        """
+            Start counting the first groups
+        """
+        self.last_time = self.clock()
+        self._schedule()
+
+    def rotate(self):
+        """
+            Account the current slice, and schedule the next groups
+        """
+        now = self.clock()
+        self._unschedule(now)
+        self.last_time = now
+        self._schedule()
+
+    def stop(self):
+        """
+            Account the current slice, and release the counters
+        """
+        if self.last_time is None:
+            return
+        self._unschedule(self.clock())
+        self.last_time = None
+
+    def read(self, event_id):
+        """
+            Return the scaled count of an event
+
+            :param event_id: The id of the event
+            :return: A tuple of estimated count and error
+        """
+        return self.events[event_id].scaled()
+
+    def get_event(self, event_id):
+        """
+            Return the counting state of an event
+
+            :param event_id: The id of the event
+            :return: A MultiplexedEvent object, with time_enabled and
+                     time_running
+        """
+        return self.events[event_id]
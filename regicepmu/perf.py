@@ -29,6 +29,16 @@
     value to performance value such as CPU load.
 """
 
+import threading
+import time
+import warnings
+from array import array
+from contextlib import ExitStack, contextmanager
+
+from regicepmu import aio
+from regicepmu.periodic import PeriodicThread
+from regicepmu.pmu import PMU
+
 class PerfEvent:
     """
         A class to read and process PMU counters
@@ -44,9 +54,15 @@ class PerfEvent:
         self.yrange = []
         self.delay = 0
         self.pmu = pmu
-        if not perf_type in pmu.perf_events:
-            pmu.perf_events[perf_type] = {}
-        pmu.perf_events[perf_type][name] = self
+        self.counters = []
+        self.is_enabled = False
+        pmu.add_perf_event(self)
+
+    def remove(self):
+        """
+            Unregister the event from its PMU
+        """
+        self.pmu.remove_perf_event(self)
 
     def _enable(self):
         pass
@@ -61,6 +77,7 @@ class PerfEvent:
         """
         self._enable()
         self.pmu.enable(refcount=True)
+        self.is_enabled = True
 
     def disable(self):
         """
@@ -68,6 +85,26 @@ class PerfEvent:
         """
         self.pmu.disable(refcount=True)
         self._disable()
+        self.is_enabled = False
+
+    def enabled(self):
+        """
+            Return True if the event has been enabled
+
+            :return: True if the event is enabled, False otherwise
+        """
+        return self.is_enabled
+
+    def get_counters(self):
+        """
+            Return the counters used to compute the event
+
+            Events should append the counters they use to self.counters,
+            in order to let the samplers read them in one pass.
+
+            :return: A list of PMUCounter objects
+        """
+        return self.counters
 
 
     def reset(self):
@@ -78,12 +115,40 @@ class PerfEvent:
         # FIXME: raise exception
         pass
 
+    @classmethod
+    def compute(cls, inputs):
+        """
+            Compute the value of events from their counters
+
+            Events implementing this can be evaluated in batch by
+            Perf.get_values(), from a single snapshot of their counters.
+
+            :param inputs: A list with the value of each counter returned by
+                           get_counters()
+            :return: The value of the events
+        """
+        raise NotImplementedError
+
+    def vectorizable(self):
+        """
+            Return True if the event implements compute()
+
+            :return: True if the event could be evaluated in batch
+        """
+        return type(self).compute.__func__ is not PerfEvent.compute.__func__
+
     def get_value(self):
         """
             Compute the value of the event, using PMU counters.
-            :return: The value of event.
+            :return: The value of event, or None if compute() divides by zero
         """
-        raise NotImplementedError
+        if not self.vectorizable():
+            raise NotImplementedError
+        try:
+            return self.compute([counter.read()
+                                 for counter in self.get_counters()])
+        except ZeroDivisionError:
+            return None
 
     def has_range(self):
         """
@@ -141,33 +206,70 @@ class MemoryLoad(PerfEvent):
 class Perf:
     """
         A class to manage perf events
+
+        Events are indexed by type and by name. The index is rebuilt
+        when a PMU or a PerfEvent is registered or removed from the device.
     """
     CPU_LOAD = 1
     MEMORY_LOAD = 2
+    SYSTEM_LOAD = 3
     def __init__(self, device):
         self.events = {}
         self.device = device
-        for pmu_name in self.device.pmus:
-            pmu = self.device.pmus[pmu_name]
-            self.events.update(pmu.perf_events)
+        self.generation = None
+        self.all_events = ()
+        self.events_by_type = {}
+        self.events_by_name = {}
+        self.events_by_key = {}
+        self.update()
+
+    def update(self):
+        """
+            Rebuild the events index if PMUs or events have changed
+
+            The index is built aside, and published before the generation,
+            so other threads never see a partial index. Lists of events
+            are published as tuples, so callers can't modify the index.
+        """
+        generation = getattr(self.device, 'perf_generation', 0)
+        if generation == self.generation:
+            return
+        all_events = []
+        events_by_type = {}
+        events_by_name = {}
+        events_by_key = {}
+        index = {}
+        for pmu in list(PMU.get_pmus(self.device).values()):
+            for event_type, events in list(pmu.perf_events.items()):
+                index.setdefault(event_type, {}).update(events)
+        for event_type, events in index.items():
+            for event in events.values():
+                all_events.append(event)
+                events_by_type.setdefault(event_type, []).append(event)
+                events_by_name.setdefault(event.name, event)
+                events_by_key[(event_type, event.name)] = event
+        self.events = index
+        self.all_events = tuple(all_events)
+        self.events_by_type = {event_type: tuple(events)
+                               for event_type, events in events_by_type.items()}
+        self.events_by_name = events_by_name
+        self.events_by_key = events_by_key
+        self.generation = generation
 
     def get_events(self, event_type=None):
         """
-            Return a list of events
+            Return a tuple of events
 
-            This returns the list of all registered events,
-            or the list of event for the specified event type.
+            This returns all the registered events,
+            or the events of the specified event type.
 
             :param event_type: The type of event to return
-            :return: A list of events
+            :return: A tuple of events
         """
-        events = []
+        self.update()
         if event_type is not None:
-            events += self.events[event_type].values()
-        else:
-            for _event_type in self.events:
-                events += self.events[_event_type].values()
-        return events
+            return self.events_by_type.get(event_type, ())
+        return self.all_events
 
     def get_events_name(self, event_type=None):
         """
@@ -193,12 +295,68 @@ class Perf:
         if not event_type and not event_name:
             return None
 
-        events = self.get_events(event_type)
-        for event in events:
-            if event.name == event_name:
-                return event
+        self.update()
+        if event_type is None:
+            return self.events_by_name.get(event_name)
+        return self.events_by_key.get((event_type, event_name))
+
+    @contextmanager
+    def tick(self, ttl=None):
+        """
+            Run a with block within a read tick of every PMU
 
-        return None
+            Within the tick, the events computed from the same counters
+            share a single read of each register.
+
+            :param ttl: If set, cached values older than ttl seconds are
+                        read again from the hardware
+        """
+        with ExitStack() as stack:
+            for pmu in PMU.get_pmus(self.device).values():
+                stack.enter_context(pmu.tick(ttl))
+            yield self
+
+    def get_values(self, events):
+        """
+            Get the value of many events
+
+            The counters of the events implementing compute() are read
+            with one snapshot per PMU, so neighbouring registers are read
+            in blocks, then each event is computed from the snapshots.
+            Events dividing by zero get None, as with get_value().
+            Other events are evaluated with get_value(), within a read tick.
+
+            :param events: A list of PerfEvent objects
+            :return: A dictionary of values, indexed by PerfEvent object
+        """
+        values = {}
+        pending = []
+        counters = set()
+        with self.tick():
+            for event in events:
+                if not event.vectorizable():
+                    values[event] = event.get_value()
+                    continue
+                event_counters = event.get_counters()
+                counters.update(event_counters)
+                pending.append((event, event_counters))
+            names = {}
+            for counter in counters:
+                names.setdefault(counter.pmu, []).append(counter.register.name)
+            raws = {}
+            for pmu, pmu_names in names.items():
+                snapshot = pmu.snapshot(sorted(pmu_names))
+                for counter in counters:
+                    if counter.pmu is pmu:
+                        raws[counter] = snapshot[counter.register.name]
+
+        for event, event_counters in pending:
+            try:
+                values[event] = event.compute([raws[counter]
+                                               for counter in event_counters])
+            except ZeroDivisionError:
+                values[event] = None
+        return values
 
     def get_value(self, event_type, event_name):
         """
@@ -212,3 +370,477 @@ class Perf:
         if not event:
             raise ValueError
         return event.get_value()
+
+    async def aget_value(self, event_type, event_name):
+        """
+            Get the value from an event, without blocking the event loop
+
+            Concurrent requests for the same event share a single read.
+
+            :param param_type: The type of the event to get
+            :param event_name: The name of the event to get
+            :return: the value read from the event
+        """
+        return await aio.run(self.device,
+                             ('value', id(self), event_type, event_name),
+                             self.get_value, event_type, event_name)
+
+    def stream(self, events, rate, maxsize=1):
+        """
+            Sample events periodically, from asyncio code
+
+            :param events: A list of PerfEvent objects
+            :param rate: The sampling rate, in Hz
+            :param maxsize: The number of samples that could wait for
+                            the consumer before sampling waits
+            :return: An asynchronous iterator of tuple of timestamp and
+                     a dictionary of values, indexed by PerfEvent object
+        """
+        return aio.stream(self, events, rate, maxsize)
+
+class RingBuffer:
+    """
+        A fixed capacity buffer of samples
+
+        Samples are stored in arrays, so memory usage doesn't grow
+        once the buffer is full: the oldest samples are overwritten.
+        :param capacity: The maximum number of samples to keep
+        :param counters_count: The number of raw counters in each sample
+    """
+    def __init__(self, capacity, counters_count):
+        if capacity < 1:
+            raise ValueError("The capacity must be at least 1")
+        self.capacity = capacity
+        self.counters_count = counters_count
+        self.timestamps = array('d', [0.0] * capacity)
+        self.values = array('d', [0.0] * capacity)
+        self.raws = array('Q', [0] * (capacity * counters_count))
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp, raws, value):
+        """
+            Add a sample to the buffer
+
+            :param timestamp: The time the sample has been taken at
+            :param raws: A list of raw counter values
+            :param value: The value of the event, or None if it couldn't
+                          be computed
+        """
+        index = self.head
+        self.timestamps[index] = timestamp
+        self.values[index] = float('nan') if value is None else value
+        base = index * self.counters_count
+        for i in range(self.counters_count):
+            self.raws[base + i] = raws[i]
+        self.head = (index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _get(self, index):
+        base = index * self.counters_count
+        return (self.timestamps[index],
+                tuple(self.raws[base:base + self.counters_count]),
+                self.values[index])
+
+    def last(self):
+        """
+            Return the most recent sample
+
+            :return: A tuple of timestamp, raw counters and value,
+                     or None if the buffer is empty
+        """
+        if not self.count:
+            return None
+        return self._get((self.head - 1) % self.capacity)
+
+    def get(self):
+        """
+            Return the samples, from the oldest to the most recent
+
+            :return: A list of tuple of timestamp, raw counters and value
+        """
+        start = (self.head - self.count) % self.capacity
+        return [self._get((start + i) % self.capacity)
+                for i in range(self.count)]
+
+    def clear(self):
+        """
+            Remove all the samples from the buffer
+        """
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+class Sampler:
+    """
+        A class to sample perf events in background
+
+        This runs a thread that periodically reads the counters of events,
+        compute events' value and store them in ring buffers.
+        An event whose value can't be computed gets a NaN sample (and None
+        is given to the listeners), the other events are still sampled.
+        :param perf: A Perf object
+        :param events: A list of PerfEvent objects to sample. If None,
+                       all the enabled events are sampled
+        :param rate: The sampling rate, in Hz
+        :param capacity: The number of samples to keep per event
+        :param max_latency: If set, the sampling interval is adapted to the
+                            growth rate of the counters, and will never be
+                            longer than max_latency seconds. The interval
+                            given by rate is used until the growth rate of
+                            every counter is known.
+        :param min_interval: The shortest sampling interval, in seconds,
+                             when the interval is adapted
+        :param safety: The fraction of a counter period to wait at most
+                       between two samples, when the interval is adapted
+    """
+    RATE_SMOOTHING = 0.5
+    MAX_STRETCH = 2.0
+
+    def __init__(self, perf, events=None, rate=10.0, capacity=1024,
+                 max_latency=None, min_interval=0.001, safety=0.5):
+        if capacity < 1:
+            raise ValueError("The capacity must be at least 1")
+        self.perf = perf
+        self.events = events
+        self.rate_interval = 1.0 / rate
+        self.interval = self.rate_interval
+        self.max_interval = None
+        self.capacity = capacity
+        self.max_latency = max_latency
+        self.min_interval = min_interval
+        self.safety = safety
+        self.rates = {}
+        self.last_values = {}
+        self.buffers = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.periodic = PeriodicThread(lambda deadline: self.sample(),
+                                       lambda: self.interval)
+
+    def add_listener(self, listener):
+        """
+            Call a function for every new sample
+
+            Listeners are called from the sampler thread.
+
+            :param listener: A function called with the event, the timestamp
+                             and the value of the sample
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+            Stop calling a function for new samples
+
+            :param listener: The function to remove
+        """
+        self.listeners.remove(listener)
+
+    def set_rate(self, rate):
+        """
+            Change the sampling rate
+
+            If the interval is adapted, the rate is then the lowest
+            sampling rate: the interval may still be shortened, but is
+            never stretched beyond the one of rate.
+
+            :param rate: The sampling rate, in Hz
+        """
+        self.rate_interval = 1.0 / rate
+        self.interval = self.rate_interval
+        self.max_interval = self.rate_interval
+
+    def _update_rates(self, snapshot):
+        pmu = snapshot.pmu
+        for name in snapshot:
+            counter = pmu.counters[name]
+            value = snapshot.read_virtual(name)
+            last = self.last_values.get(counter)
+            self.last_values[counter] = (snapshot.timestamp, value)
+            if last is None or snapshot.timestamp <= last[0]:
+                continue
+            rate = (value - last[1]) / (snapshot.timestamp - last[0])
+            if counter in self.rates:
+                rate += (self.rates[counter] - rate) * self.RATE_SMOOTHING
+            self.rates[counter] = rate
+
+    def _adapt_interval(self):
+        """
+            Compute the sampling interval from the counters growth rate
+
+            A wraparound is only detected if the counter is read at least
+            once per period, so the counters are sampled at a fraction
+            (safety) of the shortest period. The interval is bounded by
+            min_interval and max_latency, or by the interval of the rate
+            given to set_rate().
+            Until every counter has a growth rate, the interval set by the
+            sampling rate is kept. A missed wraparound would underestimate
+            the growth rate, so the interval is shortened right away, but
+            only stretched by MAX_STRETCH per sample.
+        """
+        longest = self.max_latency
+        if self.max_interval is not None:
+            longest = min(longest, self.max_interval)
+        if any(counter not in self.rates for counter in self.last_values):
+            interval = min(self.rate_interval, longest)
+            self.interval = max(interval, self.min_interval)
+            return
+        interval = longest
+        for counter, rate in self.rates.items():
+            if rate <= 0:
+                continue
+            period = (counter.mask + 1) / rate
+            interval = min(interval, period * self.safety)
+        interval = min(interval, self.interval * self.MAX_STRETCH)
+        self.interval = max(interval, self.min_interval)
+
+    def _get_events(self):
+        if self.events is not None:
+            return self.events
+        return [event for event in self.perf.get_events() if event.enabled()]
+
+    def _get_buffer(self, event):
+        buf = self.buffers.get(event)
+        if buf is None:
+            buf = RingBuffer(self.capacity, len(event.get_counters()))
+            self.buffers[event] = buf
+        return buf
+
+    def sample(self):
+        """
+            Take one sample of every events
+
+            The counters of each PMU are read in one pass, using a snapshot,
+            within a read tick, so events reading the same counters don't
+            read them again.
+        """
+        events = self._get_events()
+        counters = {}
+        for event in events:
+            counters.setdefault(event.pmu, {})
+            for counter in event.get_counters():
+                pmu_counters = counters.setdefault(counter.pmu, {})
+                pmu_counters[counter.register.name] = counter
+        with ExitStack() as stack:
+            for pmu in counters:
+                stack.enter_context(pmu.tick())
+            self._sample(events, counters)
+
+    def _sample(self, events, counters):
+        snapshots = {}
+        for pmu in counters:
+            snapshots[pmu] = pmu.snapshot(list(counters[pmu]))
+            if self.max_latency is not None:
+                self._update_rates(snapshots[pmu])
+        if self.max_latency is not None:
+            self._adapt_interval()
+
+        for event in events:
+            snapshot = snapshots[event.pmu]
+            raws = [snapshots[counter.pmu][counter.register.name]
+                    for counter in event.get_counters()]
+            try:
+                value = event.get_value()
+            except Exception as err:
+                warnings.warn("Failed to compute {}: {}".format(event.name,
+                                                                err))
+                value = None
+            with self.lock:
+                self._get_buffer(event).append(snapshot.timestamp, raws, value)
+            for listener in self.listeners:
+                listener(event, snapshot.timestamp, value)
+
+    def get_samples(self, event):
+        """
+            Return the samples of an event
+
+            :param event: The PerfEvent object to get samples from
+            :return: A list of tuple of timestamp, raw counters and value
+        """
+        with self.lock:
+            if event not in self.buffers:
+                return []
+            return self.buffers[event].get()
+
+    def get_last(self, event):
+        """
+            Return the most recent sample of an event
+
+            :param event: The PerfEvent object to get the sample from
+            :return: A tuple of timestamp, raw counters and value, or None
+        """
+        with self.lock:
+            if event not in self.buffers:
+                return None
+            return self.buffers[event].last()
+
+    def start(self):
+        """
+            Start sampling in a dedicated thread
+        """
+        self.periodic.start()
+
+    def stop(self):
+        """
+            Stop sampling, and wait for the thread to exit
+        """
+        self.periodic.stop()
+
+    def running(self):
+        """
+            Return True if the sampler thread is running
+
+            :return: True if the sampler is running, False otherwise
+        """
+        return self.periodic.running()
+
+class Subscription:
+    """
+        A request to get the value of an event periodically
+
+        :param event: The PerfEvent object to get the value of
+        :param rate: The rate to get the value at, in Hz
+        :param callback: A function called with the event, its value and
+                         the timestamp of the tick
+    """
+    def __init__(self, event, rate, callback):
+        self.event = event
+        self.rate = rate
+        self.callback = callback
+
+class PollScheduler:
+    """
+        A class to poll many events, each one at its own rate
+
+        The scheduler runs at a base tick. On each tick, it reads the union
+        of the events due, once, and gives the values to the subscribers.
+        Periods are rounded to a multiple of the base tick, which is by
+        default the shortest period of the subscriptions.
+        The tick plan is computed every time the subscriptions change.
+        :param perf: A Perf object
+        :param base_interval: The base tick, in seconds
+    """
+    def __init__(self, perf, base_interval=None):
+        self.perf = perf
+        self.base_interval = base_interval
+        self.interval = base_interval
+        self.subscriptions = []
+        self.plan = []
+        self.tick_count = 0
+        self.lock = threading.Lock()
+        self.periodic = PeriodicThread(lambda deadline: self.tick(),
+                                       lambda: self.interval or 0.1)
+
+    def subscribe(self, event, rate, callback):
+        """
+            Get the value of an event periodically
+
+            :param event: The PerfEvent object to get the value of
+            :param rate: The rate to get the value at, in Hz
+            :param callback: A function called with the event, its value and
+                             the timestamp of the tick
+            :return: A Subscription object
+        """
+        if rate <= 0:
+            raise ValueError("The rate must be positive")
+        subscription = Subscription(event, rate, callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+            self._update_plan()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+            Cancel a subscription
+
+            :param subscription: The Subscription object to cancel
+        """
+        with self.lock:
+            self.subscriptions.remove(subscription)
+            self._update_plan()
+
+    def _update_plan(self):
+        """
+            Group the subscriptions by period, counted in base ticks
+        """
+        interval = self.base_interval
+        if interval is None and self.subscriptions:
+            interval = min(1.0 / sub.rate for sub in self.subscriptions)
+        self.interval = interval
+        periods = {}
+        for sub in self.subscriptions:
+            ticks = max(1, int(round(1.0 / (sub.rate * interval))))
+            periods.setdefault(ticks, []).append(sub)
+        self.plan = []
+        for ticks in sorted(periods):
+            subs = periods[ticks]
+            events = list({id(sub.event): sub.event for sub in subs}.values())
+            self.plan.append((ticks, events, subs))
+
+    def get_due(self, tick_count):
+        """
+            Return what is due at a tick
+
+            :param tick_count: The number of the tick
+            :return: A tuple of the list of events to read, and the list
+                     of subscriptions to notify
+        """
+        events = {}
+        subs = []
+        for ticks, period_events, period_subs in self.plan:
+            if tick_count % ticks:
+                continue
+            for event in period_events:
+                events[id(event)] = event
+            subs += period_subs
+        return list(events.values()), subs
+
+    def tick(self):
+        """
+            Read the events due, and notify their subscribers
+
+            A failing event or subscriber doesn't prevent the others from
+            being notified: if the events can't be read together, they are
+            read one by one, and the subscribers of the failing ones are
+            skipped.
+        """
+        with self.lock:
+            events, subs = self.get_due(self.tick_count)
+            self.tick_count += 1
+        if not events:
+            return
+        timestamp = time.monotonic()
+        try:
+            values = self.perf.get_values(events)
+        except Exception:
+            values = {}
+            for event in events:
+                try:
+                    values.update(self.perf.get_values([event]))
+                except Exception as err:
+                    warnings.warn("Failed to poll {}: {}".format(event.name,
+                                                                 err))
+        for sub in subs:
+            if sub.event not in values:
+                continue
+            try:
+                sub.callback(sub.event, values[sub.event], timestamp)
+            except Exception as err:
+                warnings.warn("Subscriber of {} failed: {}"
+                              .format(sub.event.name, err))
+
+    def start(self):
+        """
+            Start polling in a dedicated thread
+        """
+        self.periodic.start()
+
+    def stop(self):
+        """
+            Stop polling, and wait for the thread to exit
+        """
+        self.periodic.stop()
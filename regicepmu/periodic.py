@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to call a function periodically, in a dedicated thread.
+"""
+
+import threading
+import time
+import warnings
+
+class PeriodicThread:
+    """
+        A thread calling a function at a fixed rate
+
+        Deadlines are absolute, so the rate doesn't drift with the duration
+        of the calls. A late call starts the next period immediately, the
+        missed periods are not caught up. An exception raised by a call is
+        reported with a warning, and doesn't stop the thread.
+        :param function: The function to call, with the deadline of the call
+        :param interval: A function returning the period, in seconds.
+                         It is called after every call, so the period may
+                         change while the thread runs.
+        :param clock: A function returning the current time, in seconds
+    """
+    def __init__(self, function, interval, clock=time.monotonic):
+        self.function = function
+        self.interval = interval
+        self.clock = clock
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _run(self):
+        deadline = self.clock()
+        while not self.stop_event.is_set():
+            try:
+                self.function(deadline)
+            except Exception as err:
+                warnings.warn("Periodic call failed: {}".format(err))
+            deadline += self.interval()
+            now = self.clock()
+            if deadline < now:
+                deadline = now
+            self.stop_event.wait(deadline - now)
+
+    def start(self):
+        """
+            Start calling the function, if not already started
+        """
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stop calling the function, and wait for the thread to exit
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def running(self):
+        """
+            Return True if the thread is running
+
+            :return: True if the thread is running, False otherwise
+        """
+        return self.thread is not None and self.thread.is_alive()
@@ -30,7 +30,87 @@
     and the PMU. Many methods must be implemented in architecture files.
 """
 
+import functools
+import threading
+import time
 import warnings
+from contextlib import ExitStack, contextmanager
+from types import MappingProxyType
+
+from regicepmu import aio
+from regicepmu.instrument import PMUStats
+
+_UNKNOWN = object()
+
+class CounterAllocationError(Exception):
+    """
+        Raised when no counter could be allocated for an event
+    """
+
+class ReadCache:
+    """
+        The values of the counters read during a tick
+
+        :param ttl: If set, cached values older than ttl seconds are
+                    read again from the hardware
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.values = {}
+
+    def lookup(self, counter):
+        """
+            Return the cached value of a counter
+
+            :param counter: The PMUCounter object to look for
+            :return: The cached value, or None
+        """
+        entry = self.values.get(counter.register.name)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def store(self, counter, value):
+        """
+            Store the value of a counter
+
+            :param counter: The PMUCounter object the value has been read from
+            :param value: The value read from the counter
+            :return: The value
+        """
+        self.values[counter.register.name] = (time.monotonic(), value)
+        return value
+
+    def clear(self):
+        """
+            Drop all the values
+        """
+        self.values.clear()
+
+def _reset_virtual_after(reset):
+    @functools.wraps(reset)
+    def wrapper(self, *args, **kwargs):
+        ret = reset(self, *args, **kwargs)
+        self.reset_virtual()
+        return ret
+    wrapper.resets_virtual = True
+    return wrapper
+
+def _register_address(register):
+    if hasattr(register, 'get_address'):
+        return register.get_address()
+    return register.address
+
+def _register_width(register):
+    svd = register.svd
+    width = getattr(svd, 'bitWidth', None)
+    if width is None:
+        width = getattr(svd, 'size', None)
+    if width is None:
+        width = 32
+    return int(width)
 
 class PMUCounter:
     """
@@ -40,17 +120,35 @@ class PMUCounter:
         Depending on the PMU features, counters may be enabled or disabled
         individually.
         This provides many methods to read and manage one PMU counter.
+        Counters narrower than 64 bits are virtualized: every value read
+        from the counter is used to detect wraparounds, and to maintain
+        a monotonic 64 bits value, returned by read_virtual().
+        The register is read and tracked while holding the counter lock,
+        so values read by concurrent threads are tracked in order.
+        The enable state and the event of the counter are shadowed,
+        to skip the hardware accesses that would not change anything.
+        The shadow state is only coherent with the writes done by the library,
+        resync() must be used if the hardware may have changed.
         :param pmu: A PMU object (e.g the owner of the counter)
         :param register: A RegiceObject object to use to read the register
     """
+    VIRTUAL_MASK = (1 << 64) - 1
 
     def __init__(self, pmu, register, support_event=False):
-        pmu.counters[register.name] = self
+        pmu.add_counter(self, register.name)
         self.register = register
         self.support_event = support_event
         self.event_id = None
         self.allocated = False
         self.pmu = pmu
+        self.width = _register_width(register)
+        self.mask = (1 << self.width) - 1
+        self.lock = threading.Lock()
+        self.last_raw = None
+        self.virtual = 0
+        self.wraps = 0
+        self.shadow_enabled = None
+        self.shadow_event = _UNKNOWN
 
     def _enable(self):
         pass
@@ -64,13 +162,96 @@ class PMUCounter:
     def _set_event(self, event_id):
         raise NotImplementedError
 
+    def _get_event(self):
+        raise NotImplementedError
+
+    def resync(self):
+        """
+            Read back the counter state from the hardware
+
+            This updates the shadow state, e.g if the counter has been
+            configured by something else than the library.
+        """
+        self.shadow_enabled = None
+        self.shadow_event = _UNKNOWN
+        try:
+            self.shadow_enabled = bool(self._enabled())
+        except NotImplementedError:
+            pass
+        try:
+            self.shadow_event = self._get_event()
+        except NotImplementedError:
+            pass
+
     def read(self):
         """
             Read the current value of counter
 
+            If the PMU read cache is enabled, the register is only read
+            once per tick.
+
+            :return: The current value of counter
+        """
+        cache = self.pmu.read_cache
+        if cache is None:
+            return self.read_raw()
+        value = cache.lookup(self)
+        if value is None:
+            value = cache.store(self, self.read_raw())
+        return value
+
+    def read_raw(self):
+        """
+            Read the register, bypassing the read cache
+
             :return: The current value of counter
         """
-        return int(self.register)
+        with self.lock:
+            return self.track(int(self.register))
+
+    def track(self, raw):
+        """
+            Update the virtual counter from a raw value
+
+            This must be called with every value read from the register,
+            while holding the counter lock.
+            A raw value lower than the previous one is a wraparound.
+
+            :param raw: The raw value read from the register
+            :return: The raw value
+        """
+        if self.last_raw is None:
+            self.virtual = raw
+        else:
+            if raw < self.last_raw:
+                self.wraps += 1
+            self.virtual += (raw - self.last_raw) & self.mask
+            self.virtual &= self.VIRTUAL_MASK
+        self.last_raw = raw
+        return raw
+
+    def read_virtual(self):
+        """
+            Read the counter, and return its virtual 64 bits value
+
+            Wraparounds are only detected if the counter is read at least
+            once per period of the counter.
+
+            :return: The monotonic 64 bits value of counter
+        """
+        self.read()
+        return self.virtual
+
+    def reset_virtual(self):
+        """
+            Reset the virtual counter
+
+            This must be called after a reset of the counter, otherwise
+            the reset would be detected as a wraparound.
+        """
+        self.last_raw = None
+        self.virtual = 0
+        self.wraps = 0
 
     def enable(self):
         """
@@ -84,7 +265,11 @@ class PMUCounter:
             warnings.warn("Trying to enable  {} without an assigned event".
                           format(str(self)))
             return False
-        return self._enable()
+        if self.shadow_enabled:
+            return None
+        ret = self._enable()
+        self.shadow_enabled = True
+        return ret
 
     def disable(self):
         """
@@ -94,15 +279,22 @@ class PMUCounter:
             This could be left unimplemented if the counter can't
             be individually managed.
         """
+        if self.shadow_enabled is False:
+            return
         self._disable()
+        self.shadow_enabled = False
 
     def enabled(self):
         """
             Return True if the counter is enabled
 
+            The hardware is only read if the shadow state is unknown.
+
             :return: True if the counter is enabled, False otherwise
         """
-        return self._enabled()
+        if self.shadow_enabled is None:
+            self.shadow_enabled = bool(self._enabled())
+        return self.shadow_enabled
 
     def set_event(self, event_id):
         """
@@ -122,7 +314,11 @@ class PMUCounter:
             warnings.warn("Trying to set an invalid event")
             return False
         self.event_id = event_id
-        return self._set_event(event_id)
+        if self.shadow_event == event_id:
+            return True
+        ret = self._set_event(event_id)
+        self.shadow_event = event_id
+        return ret
 
     def __str__(self):
         """
@@ -139,6 +335,65 @@ class PMUCounter:
                                      self.pmu.events[self.event_id][0])
         return "{}: (Unallocated)".format(self.register.name)
 
+class PMUSnapshot:
+    """
+        An immutable set of counter values
+
+        A snapshot holds the value of many counters, read in one pass.
+        :param pmu: The PMU object the counters belong to
+        :param values: A dictionary of counter values, indexed by counter name
+        :param timestamp: The time the counters have been read at
+        :param pause_time: How long the PMU has been paused to take
+                           the snapshot, or None if it was not paused
+        :param virtual_values: A dictionary of virtual 64 bits counter values,
+                               indexed by counter name
+    """
+    def __init__(self, pmu, values, timestamp, pause_time=None,
+                 virtual_values=None):
+        self.pmu = pmu
+        self.values = MappingProxyType(dict(values))
+        self.virtual_values = MappingProxyType(dict(virtual_values or {}))
+        self.timestamp = timestamp
+        self.pause_time = pause_time
+
+    def read(self, counter_name):
+        """
+            Return the value of a counter, as read when taking the snapshot
+
+            :param counter_name: The name of counter to read from
+            :return: The value of counter
+        """
+        return self.values[counter_name]
+
+    def read_virtual(self, counter_name):
+        """
+            Return the virtual 64 bits value of a counter
+
+            :param counter_name: The name of counter to read from
+            :return: The virtual value of counter
+        """
+        return self.virtual_values[counter_name]
+
+    def get_counters(self):
+        """
+            Return the name of counters held by the snapshot
+
+            :return: A list of counters' name
+        """
+        return list(self.values)
+
+    def __getitem__(self, counter_name):
+        return self.values[counter_name]
+
+    def __contains__(self, counter_name):
+        return counter_name in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
 class PMU:
     """
         A class to manage the PMU
@@ -151,12 +406,35 @@ class PMU:
         if not hasattr(device, 'pmus'):
             device.pmus = {}
         device.pmus[name] = self
+        PMU.changed(device)
         self.name = name
         self.device = device
         self.counters = {}
         self.events = {}
         self.perf_events = {}
+        self.event_counters = {}
+        self.counters_by_index = []
+        self.free_mask = 0
         self.refcount = 0
+        self.shadow_enabled = None
+        self.local = threading.local()
+        self.tick_count = 0
+        self.stats_recorder = None
+        self.snapshot_max_gap = 16
+        self.last_pause_time = None
+        self.total_pause_time = 0.0
+        self.pause_count = 0
+
+    def __init_subclass__(cls, **kwargs):
+        """
+            Make the reset() of architectures reset the virtual counters
+
+            Otherwise, the reset would be detected as a wraparound.
+        """
+        super(PMU, cls).__init_subclass__(**kwargs)
+        reset = cls.__dict__.get('reset')
+        if reset is not None and not getattr(reset, 'resets_virtual', False):
+            cls.reset = _reset_virtual_after(reset)
 
     @staticmethod
     def get_pmus(device):
@@ -170,6 +448,50 @@ class PMU:
             return device.pmus
         return {}
 
+    @staticmethod
+    def changed(device):
+        """
+            Notify that PMUs or perf events of a device have changed
+
+            This increments the generation of device's perf events,
+            used by Perf objects to keep their index up to date.
+
+            :param device: A Device object (e.g the owner of the PMU)
+        """
+        device.perf_generation = getattr(device, 'perf_generation', 0) + 1
+
+    def remove(self):
+        """
+            Unregister the PMU from its device
+        """
+        pmus = PMU.get_pmus(self.device)
+        if pmus.get(self.name) is self:
+            del pmus[self.name]
+            PMU.changed(self.device)
+
+    def add_perf_event(self, perf_event):
+        """
+            Register a perf event
+
+            :param perf_event: The PerfEvent object to register
+        """
+        events = self.perf_events.setdefault(perf_event.type, {})
+        events[perf_event.name] = perf_event
+        PMU.changed(self.device)
+
+    def remove_perf_event(self, perf_event):
+        """
+            Unregister a perf event
+
+            :param perf_event: The PerfEvent object to unregister
+        """
+        events = self.perf_events.get(perf_event.type, {})
+        if events.get(perf_event.name) is perf_event:
+            del events[perf_event.name]
+            if not events:
+                del self.perf_events[perf_event.type]
+            PMU.changed(self.device)
+
     def _enable(self):
         raise NotImplementedError
 
@@ -189,7 +511,10 @@ class PMU:
         if refcount:
             self.refcount += 1
         if self.refcount == 1 or refcount is False:
+            if self.shadow_enabled:
+                return
             self._enable()
+            self.shadow_enabled = True
 
     def disable(self, refcount=False):
         """
@@ -201,15 +526,38 @@ class PMU:
         if refcount:
             self.refcount -= 1
         if self.refcount == 0:
+            if self.shadow_enabled is False:
+                return
             self._disable()
+            self.shadow_enabled = False
 
     def enabled(self):
         """
             Return True if the PMU is enabled
 
+            The hardware is only read if the shadow state is unknown.
+
             :return: True if the PMU is enabled, False otherwise
         """
-        return self._enabled()
+        if self.shadow_enabled is None:
+            self.shadow_enabled = bool(self._enabled())
+        return self.shadow_enabled
+
+    def resync(self):
+        """
+            Read back the PMU and counters state from the hardware
+
+            The PMU and counters keep a shadow of the state written to the
+            hardware. This must be called if the hardware may have been
+            configured by something else than the library.
+        """
+        self.shadow_enabled = None
+        try:
+            self.shadow_enabled = bool(self._enabled())
+        except NotImplementedError:
+            pass
+        for counter in self.counters.values():
+            counter.resync()
 
     def pause(self):
         """
@@ -233,6 +581,8 @@ class PMU:
             Reset the PMU
 
             This reset the PMU, e.g reset all the counters.
+            The virtual counters are reset once the reset of the
+            architecture returns.
         """
         raise NotImplementedError
 
@@ -253,6 +603,343 @@ class PMU:
         """
         return self.counters[counter_name].read()
 
+    async def aread(self, counter_name):
+        """
+            Read the value from a counter, without blocking the event loop
+
+            Concurrent reads of the same counter share a single read.
+
+            :param counter_name: The name of counter to read from
+            :return: The value of counter
+        """
+        return await aio.run(self.device, ('read', id(self), counter_name),
+                             self.read, counter_name)
+
+    def read_virtual(self, counter_name):
+        """
+            Read the virtual 64 bits value from a counter
+
+            :param counter_name: The name of counter to read from
+            :return: The virtual value of counter
+        """
+        return self.counters[counter_name].read_virtual()
+
+    def reset_virtual(self):
+        """
+            Reset the virtual value of all the counters
+
+            This is done by reset(), and must only be called directly if
+            the counters have been reset by something else.
+        """
+        for counter in self.counters.values():
+            counter.reset_virtual()
+
+    def _snapshot_counters(self, counter_names=None):
+        if counter_names is not None:
+            return [self.counters[name] for name in counter_names]
+        return [counter for counter in self.counters.values()
+                if not counter.support_event or counter.allocated]
+
+    def _plan_reads(self, counters):
+        """
+            Merge the counters registers into as few block reads as possible
+
+            Registers of same width are merged in one block if the gap
+            between them is smaller than snapshot_max_gap bytes.
+
+            :param counters: A list of counters to read
+            :return: A list of blocks, each block being a tuple of
+                     width, address, words count and a list of counters
+        """
+        located = sorted(((_register_width(counter.register),
+                           _register_address(counter.register), counter)
+                          for counter in counters),
+                         key=lambda item: (item[0], item[1]))
+        blocks = []
+        for width, address, counter in located:
+            stride = max(width // 8, 1)
+            if blocks:
+                block = blocks[-1]
+                end = block[1] + block[2] * stride
+                if block[0] == width and address - end <= self.snapshot_max_gap:
+                    count = max(block[2], (address - block[1]) // stride + 1)
+                    blocks[-1] = (width, block[1], count, block[3] + [counter])
+                    continue
+            blocks.append((width, address, 1, [counter]))
+        return blocks
+
+    def _read_block(self, width, address, count):
+        """
+            Read a block of consecutive words
+
+            This uses the block read of the regice client if available.
+            Architecture or transport may override it.
+
+            :param width: The width of words, in bits
+            :param address: The address of the first word
+            :param count: The number of words to read
+            :return: A list of words, or None if block read is not supported
+        """
+        client = self.device.client
+        if not hasattr(client, 'read_block'):
+            return None
+        return client.read_block(width, address, count)
+
+    def _read_counters(self, blocks):
+        """
+            Read the blocks planned by _plan_reads()
+
+            Counters may belong to other PMUs of the same device, their
+            values are then stored in the read cache of their own PMU.
+            The registers are always read, the read cache is never used.
+
+            :param blocks: A list of blocks returned by _plan_reads()
+            :return: A dictionary of values, indexed by PMUCounter object
+        """
+        values = {}
+        for width, address, count, block in blocks:
+            if len(block) > 1:
+                with ExitStack() as stack:
+                    for counter in block:
+                        stack.enter_context(counter.lock)
+                    if self._read_block_locked(width, address, count, block,
+                                               values):
+                        continue
+            for counter in block:
+                value = counter.read_raw()
+                counter.pmu.cache_store(counter, value)
+                values[counter] = value
+        return values
+
+    def _read_block_locked(self, width, address, count, block, values):
+        """
+            Read and track a block, with the locks of its counters held
+
+            Blocks are planned in address order, so the locks are always
+            taken in the same order.
+
+            :return: False if block read is not supported
+        """
+        words = self._read_block(width, address, count)
+        if words is None:
+            return False
+        stride = max(width // 8, 1)
+        for counter in block:
+            offset = (_register_address(counter.register) - address) // stride
+            value = counter.track(words[offset])
+            counter.pmu.cache_store(counter, value)
+            values[counter] = value
+        return True
+
+    @staticmethod
+    def _values_by_name(values):
+        return {counter.register.name: value
+                for counter, value in values.items()}
+
+    def _virtual_values(self, values):
+        return {name: self.counters[name].virtual for name in values}
+
+    def snapshot(self, counter_names=None):
+        """
+            Read many counters in one pass
+
+            This computes the address of the counters to read, and merge
+            neighbouring registers into as few block reads as possible.
+
+            :param counter_names: A list of counters' name to read.
+                                  If None, all the enabled counters are read
+                                  (e.g the counters that don't support events,
+                                  and the counters allocated to an event)
+            :return: A PMUSnapshot object
+        """
+        counters = self._snapshot_counters(counter_names)
+        values = {}
+        cache = self.read_cache
+        if cache is not None:
+            pending = []
+            for counter in counters:
+                value = cache.lookup(counter)
+                if value is None:
+                    pending.append(counter)
+                else:
+                    values[counter.register.name] = value
+            counters = pending
+        blocks = self._plan_reads(counters)
+        timestamp = time.monotonic()
+        values.update(self._values_by_name(self._read_counters(blocks)))
+        return PMUSnapshot(self, values, timestamp,
+                           virtual_values=self._virtual_values(values))
+
+    def enable_stats(self, caller=False):
+        """
+            Start recording statistics of the register accesses
+
+            This records the count, bytes and latency histogram of
+            the counters operations, of the block reads and of the PMU
+            control operations.
+
+            :param caller: If True, statistics are also split by caller
+        """
+        if self.stats_recorder is not None:
+            return
+        self.stats_recorder = PMUStats(self, caller)
+        self.stats_recorder.instrument_transport()
+        self.stats_recorder.instrument_pmu()
+        for counter in self.counters.values():
+            self.stats_recorder.instrument_counter(counter)
+
+    def disable_stats(self):
+        """
+            Stop recording statistics, and drop them
+        """
+        if self.stats_recorder is None:
+            return
+        self.stats_recorder.uninstrument()
+        self.stats_recorder = None
+
+    def stats(self):
+        """
+            Return the statistics of the register accesses
+
+            :return: A dictionary of statistics, indexed by a tuple of
+                     target name, operation and caller, or None if
+                     statistics are disabled
+        """
+        if self.stats_recorder is None:
+            return None
+        return self.stats_recorder.get()
+
+    @property
+    def read_cache(self):
+        """
+            The ReadCache object of the tick of the calling thread,
+            or None if the thread is not within a tick
+        """
+        return getattr(self.local, 'cache', None)
+
+    def begin_tick(self, ttl=None, cache=None):
+        """
+            Start a new read tick
+
+            Within a tick, each counter register is read from the hardware
+            only once, the following reads are served from the read cache.
+            A tick belongs to the calling thread: reads from other threads
+            don't use its cache, unless it is given to them.
+
+            :param ttl: If set, cached values older than ttl seconds are
+                        read again from the hardware
+            :param cache: A ReadCache object to use, e.g the cache of a
+                          tick of another thread. By default, a new one.
+        """
+        if cache is None:
+            cache = ReadCache(ttl)
+        self.local.cache = cache
+        self.tick_count += 1
+
+    def end_tick(self):
+        """
+            End the read tick of the calling thread
+        """
+        self.local.cache = None
+
+    def clear_read_cache(self):
+        """
+            Drop the values of the read cache, without ending the tick
+        """
+        cache = self.read_cache
+        if cache is not None:
+            cache.clear()
+
+    @contextmanager
+    def tick(self, ttl=None, cache=None):
+        """
+            Run a with block within a read tick
+
+            If the calling thread is already within a tick, it is reused.
+
+            :param ttl: If set, cached values older than ttl seconds are
+                        read again from the hardware
+            :param cache: A ReadCache object to use, e.g the cache of a
+                          tick of another thread. By default, a new one.
+        """
+        if self.read_cache is not None:
+            yield self
+            return
+        self.begin_tick(ttl, cache)
+        try:
+            yield self
+        finally:
+            self.end_tick()
+
+    def cache_lookup(self, counter):
+        """
+            Return the cached value of a counter
+
+            :param counter: The PMUCounter object to look for
+            :return: The cached value, or None if it is not cached or
+                     if the calling thread is not within a tick
+        """
+        cache = self.read_cache
+        if cache is None:
+            return None
+        return cache.lookup(counter)
+
+    def cache_store(self, counter, value):
+        """
+            Store the value of a counter in the read cache
+
+            This does nothing if the calling thread is not within a tick.
+
+            :param counter: The PMUCounter object the value has been read from
+            :param value: The value read from the counter
+            :return: The value
+        """
+        cache = self.read_cache
+        if cache is not None:
+            cache.store(counter, value)
+        return value
+
+    def _record_pause(self, pause_time):
+        self.last_pause_time = pause_time
+        self.total_pause_time += pause_time
+        self.pause_count += 1
+
+    @contextmanager
+    def pause_window(self):
+        """
+            Pause the PMU for the duration of a with block
+
+            The PMU is resumed when leaving the block, even if an exception
+            has been raised. The time the PMU has been paused is recorded in
+            last_pause_time, and accumulated in total_pause_time.
+        """
+        start = time.perf_counter()
+        self.pause()
+        try:
+            yield self
+        finally:
+            self.resume()
+            self._record_pause(time.perf_counter() - start)
+
+    def consistent_snapshot(self, counter_names=None):
+        """
+            Read many counters in one pass, while the PMU is paused
+
+            The reads are planned before pausing the PMU, so it is only
+            paused while fetching the counters, and resumed right away.
+
+            :param counter_names: A list of counters' name to read.
+                                  If None, all the enabled counters are read
+            :return: A PMUSnapshot object, with the pause duration
+                     in pause_time
+        """
+        blocks = self._plan_reads(self._snapshot_counters(counter_names))
+        with self.pause_window():
+            timestamp = time.monotonic()
+            values = self._values_by_name(self._read_counters(blocks))
+        return PMUSnapshot(self, values, timestamp, self.last_pause_time,
+                           self._virtual_values(values))
+
     def get_events(self):
         """
             Return a dictionary of events that could assigned to a counter
@@ -261,16 +948,246 @@ class PMU:
         """
         return self.events
 
-    def _alloc_counter(self):
-        for counter_name in self.counters:
-            counter = self.counters[counter_name]
-            if counter.support_event and not counter.allocated:
-                counter.allocated = True
-                return counter
-        raise Exception
+    def add_counter(self, counter, name):
+        """
+            Register a counter
+
+            Each counter gets an index, used as bit in the free counters
+            bitmap and in the event counter masks. A counter replacing
+            another counter with the same name keeps its index.
+
+            :param counter: The PMUCounter object to register
+            :param name: The name of the counter
+        """
+        old = self.counters.get(name)
+        if old is not None:
+            counter.index = old.index
+            self.counters_by_index[counter.index] = counter
+        else:
+            counter.index = len(self.counters_by_index)
+            self.counters_by_index.append(counter)
+        self.counters[name] = counter
+        self.free_mask |= 1 << counter.index
+        if self.stats_recorder is not None:
+            self.stats_recorder.instrument_counter(counter)
+
+    def set_event_counters(self, event_id, counter_names):
+        """
+            Restrict the counters an event could be assigned to
+
+            :param event_id: The id of the event
+            :param counter_names: A list of counters' name that could count
+                                  the event, or None to allow any counter
+        """
+        if counter_names is None:
+            self.event_counters.pop(event_id, None)
+            return
+        mask = 0
+        for name in counter_names:
+            mask |= 1 << self.counters[name].index
+        self.event_counters[event_id] = mask
+
+    def _event_mask(self, event_id):
+        return self.event_counters.get(event_id, -1)
+
+    def _free_counters(self, mask, free_mask=None):
+        if free_mask is None:
+            free_mask = self.free_mask
+        mask &= free_mask
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            counter = self.counters_by_index[bit.bit_length() - 1]
+            if counter.support_event:
+                yield counter
+
+    def _alloc_counter(self, event_id=None):
+        for counter in self._free_counters(self._event_mask(event_id)):
+            counter.allocated = True
+            self.free_mask &= ~(1 << counter.index)
+            return counter
+        raise CounterAllocationError("No counter available for event {}".
+                                     format(event_id))
 
     def _free_counter(self, counter):
         counter.allocated = False
+        self.free_mask |= 1 << counter.index
+
+    def _match_counters(self, event_ids, free_mask=None):
+        """
+            Find a counter for each event
+
+            This solves the bipartite matching between events and free
+            counters, using augmenting paths, so a placement is found
+            whenever one exists.
+
+            :param event_ids: A list of events' id
+            :param free_mask: The bitmap of counters to use,
+                              by default the free counters
+            :return: A list of counters, one per event, or None
+        """
+        candidates = [list(self._free_counters(self._event_mask(event_id),
+                                               free_mask))
+                      for event_id in event_ids]
+        owners = {}
+
+        def augment(event, visited):
+            for counter in candidates[event]:
+                if counter not in owners:
+                    owners[counter] = event
+                    return True
+            for counter in candidates[event]:
+                if counter in visited:
+                    continue
+                visited.add(counter)
+                if counter not in owners or augment(owners[counter], visited):
+                    owners[counter] = event
+                    return True
+            return False
+
+        order = sorted(range(len(event_ids)), key=lambda i: len(candidates[i]))
+        for event in order:
+            if not augment(event, set()):
+                return None
+        placement = [None] * len(event_ids)
+        for counter, event in owners.items():
+            placement[event] = counter
+        return placement
+
+    def alloc_counters(self, event_ids):
+        """
+            Allocate a counter for each event
+
+            Either all the events get a counter, or none of them does.
+
+            :param event_ids: A list of events' id
+            :return: A list of counters, one per event
+        """
+        placement = self._match_counters(event_ids)
+        if placement is None:
+            raise CounterAllocationError("No placement for events {}".
+                                         format(list(event_ids)))
+        for counter in placement:
+            counter.allocated = True
+            self.free_mask &= ~(1 << counter.index)
+        return placement
+
+    def _enable_counter(self, counter, event_id):
+        if not counter.set_event(event_id):
+            warnings.warn("Failed to assign event {} to {}".
+                          format(self.events[event_id], str(counter)))
+        counter.enable()
+
+    def enable_events(self, event_ids):
+        """
+            Enable many events
+
+            This finds a placement of all the events on the free counters,
+            then assigns the events to the counters and enables them.
+
+            :param event_ids: A list of events' id to enable
+            :return: A list of counters used to enable the events
+        """
+        counters = self.alloc_counters(event_ids)
+        for counter, event_id in zip(counters, event_ids):
+            self._enable_counter(counter, event_id)
+        return counters
+
+    def _set_counters_enabled(self, enable, disable):
+        """
+            Enable and disable many counters
+
+            Architectures where counters are enabled through a single mask
+            register should override this, to update the mask with one
+            read-modify-write, and set shadow_enabled of the counters.
+
+            :param enable: A list of counters to enable
+            :param disable: A list of counters to disable
+        """
+        for counter in disable:
+            counter.disable()
+        for counter in enable:
+            counter.enable()
+
+    def _plan_configuration(self, event_ids):
+        """
+            Compute the counters to use for a set of events
+
+            Counters already counting one of the events are kept.
+            The other events are placed on the free counters and on the
+            counters that are not needed anymore. If this fails, all the
+            events are placed again from scratch.
+
+            :param event_ids: A list of events' id
+            :return: A list of counters, one per event
+        """
+        placement = [None] * len(event_ids)
+        wanted = {}
+        for i, event_id in enumerate(event_ids):
+            wanted.setdefault(event_id, []).append(i)
+        available = self.free_mask
+        for counter in self.counters_by_index:
+            if not counter.support_event or not counter.allocated:
+                continue
+            positions = wanted.get(counter.event_id)
+            if positions:
+                placement[positions.pop()] = counter
+            else:
+                available |= 1 << counter.index
+
+        missing = [i for i, counter in enumerate(placement) if counter is None]
+        counters = self._match_counters([event_ids[i] for i in missing],
+                                        available)
+        if counters is not None:
+            for i, counter in zip(missing, counters):
+                placement[i] = counter
+            return placement
+
+        available = 0
+        for counter in self.counters_by_index:
+            if counter.support_event:
+                available |= 1 << counter.index
+        placement = self._match_counters(event_ids, available)
+        if placement is None:
+            raise CounterAllocationError("No placement for events {}".
+                                         format(list(event_ids)))
+        return placement
+
+    def configure(self, events):
+        """
+            Configure the counters to count a set of events
+
+            This computes the counters layout for the events, and only
+            writes what differs from the current configuration: counters
+            already counting an event are left untouched, and the counters
+            are enabled and disabled in batches.
+
+            :param events: A list of events' id to count
+            :return: A list of counters, one per event
+        """
+        placement = self._plan_configuration(events)
+        used = set(placement)
+        release = [counter for counter in self.counters_by_index
+                   if counter.allocated and counter not in used]
+        assign = [(counter, event_id)
+                  for counter, event_id in zip(placement, events)
+                  if not counter.allocated or counter.event_id != event_id]
+
+        disable = release + [counter for counter, _ in assign
+                             if counter.allocated]
+        if disable:
+            self._set_counters_enabled([], disable)
+        for counter in release:
+            self._free_counter(counter)
+        for counter, event_id in assign:
+            counter.allocated = True
+            self.free_mask &= ~(1 << counter.index)
+            if not counter.set_event(event_id):
+                warnings.warn("Failed to assign event {} to {}".
+                              format(self.events[event_id], str(counter)))
+        if assign:
+            self._set_counters_enabled([counter for counter, _ in assign], [])
+        return placement
 
     def enable_event(self, event_id):
         """
@@ -281,11 +1198,8 @@ class PMU:
             :param event_id: The id of the event to enable
             :return: The counter used to enable the event
         """
-        counter = self._alloc_counter()
-        if not counter.set_event(event_id):
-            warnings.warn("Failed to assign event {} to {}".
-                          format(self.events[event_id], str(counter)))
-        counter.enable()
+        counter = self._alloc_counter(event_id)
+        self._enable_counter(counter, event_id)
         return counter
 
     def disable_event(self, counter):
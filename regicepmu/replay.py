@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to replay a recorded capture as a simulated PMU.
+
+    ReplayPMU and its counters are backed by a capture or a trace instead
+    of registers, so the PerfEvent code runs unchanged against a recording.
+"""
+
+import time
+
+from regicepmu.pmu import PMU, PMUCounter
+
+class ReplayDevice:
+    """
+        A device without registers, owning replay PMUs
+
+        :param name: The name of the device
+    """
+    def __init__(self, name='replay'):
+        self.name = name
+        self.client = None
+        self.pmus = {}
+
+class _ReplaySVD:
+    def __init__(self, size):
+        self.size = size
+
+class ReplayRegister:
+    """
+        A register returning the recorded value of a counter
+
+        :param pmu: The ReplayPMU object owning the register
+        :param name: The name of the counter
+        :param index: The index of the counter in the records
+        :param width: The width of the counter, in bits
+    """
+    def __init__(self, pmu, name, index, width):
+        self.pmu = pmu
+        self.name = name
+        self.index = index
+        self.svd = _ReplaySVD(width)
+        self.address = index * 8
+
+    def read(self):
+        """
+            Return the recorded value of the counter
+
+            :return: The value of the counter
+        """
+        return self.pmu.get_recorded(self.index)
+
+    def write(self, value):
+        """
+            Registers of a replay can't be written
+        """
+        raise NotImplementedError
+
+    def __int__(self):
+        return self.read()
+
+class ReplayCounter(PMUCounter):
+    """
+        A counter backed by a recording
+
+        A counter that was counting an event during the recording supports
+        events, but can only be assigned the recorded event.
+        :param pmu: The ReplayPMU object owning the counter
+        :param register: The ReplayRegister object of the counter
+        :param event_id: The id of the event recorded by the counter,
+                         or None
+    """
+    def __init__(self, pmu, register, event_id=None):
+        super(ReplayCounter, self).__init__(pmu, register,
+                                            support_event=event_id is not None)
+        self.recorded_event = event_id
+        self.en = False
+
+    def _enable(self):
+        self.en = True
+
+    def _disable(self):
+        self.en = False
+
+    def _enabled(self):
+        if not self.support_event:
+            return self.pmu.en
+        return self.en
+
+    def _set_event(self, event_id):
+        return event_id is None or event_id == self.recorded_event
+
+    def _get_event(self):
+        return self.recorded_event
+
+def _iter_records(capture):
+    if hasattr(capture, 'read'):
+        for record in capture.read():
+            yield record
+        return
+    for row in capture.records:
+        yield int(row[0]) / 1e9, tuple(int(value) for value in row[1:])
+
+class ReplayPMU(PMU):
+    """
+        A PMU replaying a recorded capture
+
+        In real time mode, the records are replayed following their
+        timestamps, time being frozen while the PMU is paused.
+        Otherwise, records are replayed as fast as possible: the next record
+        is loaded on every advance_on operation, or on advance(). The first
+        operation gets the first record.
+        Events can only be enabled on the counters that recorded them.
+        :param device: A Device object (e.g the owner of the PMU)
+        :param name: The name of the PMU
+        :param capture: A CaptureReader or a TraceReader object
+        :param realtime: True to replay the records in real time
+        :param clock: A function returning the current time, in seconds
+        :param advance_on: The operation loading the next record, when not
+                           in real time: 'tick' (a read tick, as done by
+                           Sampler or Perf.get_values()), 'snapshot',
+                           'pause', or None to only advance on advance()
+    """
+    ADVANCE_OPERATIONS = ('tick', 'snapshot', 'pause', None)
+
+    def __init__(self, device, name, capture, realtime=False,
+                 clock=time.monotonic, advance_on='tick'):
+        if advance_on not in self.ADVANCE_OPERATIONS:
+            raise ValueError("Invalid advance operation {}".format(advance_on))
+        super(ReplayPMU, self).__init__(device, name)
+        self.events = dict(capture.events)
+        self.realtime = realtime
+        self.clock = clock
+        self.advance_on = advance_on
+        self.capture = capture
+        self.en = False
+        self.paused = False
+        self.finished = False
+        for index, counter in enumerate(capture.counters):
+            register = ReplayRegister(self, counter['name'], index,
+                                      counter['width'])
+            ReplayCounter(self, register, counter.get('event'))
+        for event_id in self.events:
+            self.set_event_counters(event_id,
+                                    [counter['name']
+                                     for counter in capture.counters
+                                     if counter.get('event') == event_id])
+        self.rewind()
+
+    def rewind(self):
+        """
+            Restart the replay from the first record
+        """
+        self.records = _iter_records(self.capture)
+        self.finished = False
+        self.timestamp = None
+        self.values = [0] * len(self.counters)
+        self.base = [0] * len(self.counters)
+        self.origin = None
+        self.pause_time = None
+        self.next_record = next(self.records, None)
+        self.advance()
+        self.fresh = True
+        self.reset_virtual()
+
+    def advance(self):
+        """
+            Load the next record
+
+            :return: False if there is no more record, True otherwise
+        """
+        self.fresh = False
+        if self.next_record is None:
+            self.finished = True
+            return False
+        self.timestamp, values = self.next_record
+        self.values = list(values)
+        self.next_record = next(self.records, None)
+        return True
+
+    def _trigger(self, operation):
+        if self.realtime or self.advance_on != operation:
+            return
+        if self.fresh:
+            self.fresh = False
+        else:
+            self.advance()
+
+    def begin_tick(self, ttl=None, cache=None):
+        self._trigger('tick')
+        super(ReplayPMU, self).begin_tick(ttl, cache)
+
+    def snapshot(self, counter_names=None):
+        self._trigger('snapshot')
+        return super(ReplayPMU, self).snapshot(counter_names)
+
+    def _now(self):
+        if self.pause_time is not None:
+            return self.pause_time
+        return self.clock()
+
+    def _sync(self):
+        if not self.realtime:
+            return
+        if self.origin is None:
+            self.origin = self._now() - self.timestamp
+        target = self._now() - self.origin
+        while self.next_record is not None and self.next_record[0] <= target:
+            self.advance()
+        if self.next_record is None and target > self.timestamp:
+            self.finished = True
+
+    def get_recorded(self, index):
+        """
+            Return the current recorded value of a counter
+
+            :param index: The index of the counter in the records
+            :return: The value of the counter, relative to the last reset
+        """
+        self._sync()
+        counter = self.counters_by_index[index]
+        return (self.values[index] - self.base[index]) & counter.mask
+
+    def _enable(self):
+        self.en = True
+
+    def _disable(self):
+        self.en = False
+
+    def _enabled(self):
+        return self.en
+
+    def pause(self):
+        self.paused = True
+        if self.realtime:
+            self._sync()
+            self.pause_time = self.clock()
+        else:
+            self._trigger('pause')
+
+    def resume(self):
+        if self.pause_time is not None and self.origin is not None:
+            self.origin += self.clock() - self.pause_time
+        self.pause_time = None
+        self.paused = False
+
+    def reset(self):
+        self._sync()
+        self.base = list(self.values)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to archive counter samples in a compressed trace file.
+
+    Records are gathered in chunks. In a chunk, the first record is stored
+    as is, and the following ones as the difference with the previous record,
+    using zigzag and varint encoding. Each chunk is compressed on its own.
+    An index of the chunks, written at the end of the trace, lets a reader
+    decode only the chunks overlapping a time window.
+"""
+
+import bisect
+import json
+import struct
+import zlib
+
+from regicepmu.capture import make_header
+
+MAGIC = b'RPMUTRC\0'
+INDEX_MAGIC = b'RPMUIDX\0'
+VERSION = 1
+_PREAMBLE = struct.Struct('<8sII')
+_CHUNK = struct.Struct('<QQII')
+_INDEX_ENTRY = struct.Struct('<QQQI')
+_FOOTER = struct.Struct('<QI8s')
+
+class TraceError(Exception):
+    """
+        Raised when a trace file is invalid
+    """
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+def _write_varint(data, value):
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+def encode_chunk(records):
+    """
+        Encode records, as zigzag varint deltas
+
+        :param records: A list of records, each record being a tuple of
+                        timestamp in ns and counter values
+        :return: The encoded records
+    """
+    data = bytearray()
+    previous = None
+    for record in records:
+        if previous is None:
+            for value in record:
+                _write_varint(data, value)
+        else:
+            for value, last in zip(record, previous):
+                _write_varint(data, _zigzag(value - last))
+        previous = record
+    return bytes(data)
+
+def decode_chunk(data, count, width):
+    """
+        Decode records encoded by encode_chunk()
+
+        :param data: The encoded records
+        :param count: The number of records
+        :param width: The number of values per record
+        :return: A list of records
+    """
+    records = []
+    offset = 0
+    previous = None
+    for _ in range(count):
+        record = []
+        for i in range(width):
+            value, offset = _read_varint(data, offset)
+            if previous is not None:
+                value = previous[i] + _unzigzag(value)
+            record.append(value)
+        previous = record
+        records.append(tuple(record))
+    return records
+
+class TraceWriter:
+    """
+        A class to write a compressed trace file
+
+        Only one chunk of records is kept in memory. The index holds one
+        small entry per chunk.
+        :param path: The path of the trace file
+        :param pmu: The PMU object the counters belong to
+        :param counter_names: A list of counters' name to record,
+                              by default all the PMU counters
+        :param chunk_size: The number of records per chunk
+        :param level: The zlib compression level
+    """
+    def __init__(self, path, pmu, counter_names=None, chunk_size=4096,
+                 level=6):
+        if counter_names is None:
+            counter_names = list(pmu.counters)
+        self.counter_names = list(counter_names)
+        self.chunk_size = chunk_size
+        self.level = level
+        self.records = []
+        self.index = []
+        self.count = 0
+        data = json.dumps(make_header(pmu, self.counter_names)).encode('utf-8')
+        self.file = open(path, 'wb')
+        self.file.write(_PREAMBLE.pack(MAGIC, VERSION, len(data)))
+        self.file.write(data)
+
+    def write(self, timestamp, values):
+        """
+            Write a record
+
+            :param timestamp: The time of the record, in seconds
+            :param values: A list of counter values, in the order of
+                           counter_names
+        """
+        self.records.append((int(round(timestamp * 1e9)),) + tuple(values))
+        self.count += 1
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def write_snapshot(self, snapshot):
+        """
+            Write a record from a snapshot
+
+            :param snapshot: A PMUSnapshot object holding the recorded counters
+        """
+        self.write(snapshot.timestamp,
+                   [snapshot[name] for name in self.counter_names])
+
+    def flush(self):
+        """
+            Encode, compress and write the pending records as a chunk
+        """
+        if not self.records:
+            return
+        data = zlib.compress(encode_chunk(self.records), self.level)
+        first = self.records[0][0]
+        last = self.records[-1][0]
+        self.index.append((first, last, self.file.tell(), len(self.records)))
+        self.file.write(_CHUNK.pack(first, last, len(self.records), len(data)))
+        self.file.write(data)
+        self.records = []
+
+    def close(self):
+        """
+            Write the pending records and the chunk index, and close the file
+        """
+        self.flush()
+        offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(_INDEX_ENTRY.pack(*entry))
+        self.file.write(_FOOTER.pack(offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TraceReader:
+    """
+        A class to read a compressed trace file
+
+        :param path: The path of the trace file
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        magic, version, length = _PREAMBLE.unpack(
+            self.file.read(_PREAMBLE.size))
+        if magic != MAGIC or version != VERSION:
+            self.file.close()
+            raise TraceError("{} is not a trace file".format(path))
+        header = json.loads(self.file.read(length).decode('utf-8'))
+        self.pmu_name = header['pmu']
+        self.counters = header['counters']
+        self.counter_names = [counter['name'] for counter in self.counters]
+        self.events = {int(event_id): event
+                       for event_id, event in header['events'].items()}
+
+        self.file.seek(-_FOOTER.size, 2)
+        offset, count, magic = _FOOTER.unpack(self.file.read(_FOOTER.size))
+        if magic != INDEX_MAGIC:
+            self.file.close()
+            raise TraceError("{} has no chunk index".format(path))
+        self.file.seek(offset)
+        data = self.file.read(count * _INDEX_ENTRY.size)
+        self.index = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)
+                      for i in range(count)]
+        self.last_timestamps = [entry[1] for entry in self.index]
+
+    def __len__(self):
+        return sum(entry[3] for entry in self.index)
+
+    def _read_chunk(self, entry):
+        self.file.seek(entry[2])
+        _, _, count, length = _CHUNK.unpack(self.file.read(_CHUNK.size))
+        data = zlib.decompress(self.file.read(length))
+        return decode_chunk(data, count, len(self.counter_names) + 1)
+
+    def read(self, start=None, end=None):
+        """
+            Read the records in a time range
+
+            Only the chunks overlapping the range are decoded.
+
+            :param start: The start of the range, in seconds
+            :param end: The end of the range (excluded), in seconds
+            :return: An iterator of tuple of timestamp, in seconds,
+                     and a tuple of counter values
+        """
+        first = 0
+        start_ns = None
+        end_ns = None
+        if start is not None:
+            start_ns = int(round(start * 1e9))
+            first = bisect.bisect_left(self.last_timestamps, start_ns)
+        if end is not None:
+            end_ns = int(round(end * 1e9))
+        for entry in self.index[first:]:
+            if end_ns is not None and entry[0] >= end_ns:
+                break
+            for record in self._read_chunk(entry):
+                if start_ns is not None and record[0] < start_ns:
+                    continue
+                if end_ns is not None and record[0] >= end_ns:
+                    break
+                yield record[0] / 1e9, record[1:]
+
+    def close(self):
+        """
+            Close the trace file
+        """
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
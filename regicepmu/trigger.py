@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    A module to capture event values only around a trigger.
+
+    Between triggers, events are sampled at a low rate and only the last
+    samples are kept in memory. When the trigger fires, the sampling rate is
+    raised, and the samples before and after the trigger are handed over to
+    be saved.
+"""
+
+from collections import deque
+
+class Trigger:
+    """
+        A condition on the values of an event
+
+        The trigger fires when the condition holds for count successive
+        samples, and is armed again once the condition doesn't hold anymore.
+        :param event: The PerfEvent object to watch
+        :param above: Fire when the value is greater than this
+        :param below: Fire when the value is lower than this
+        :param slope: Fire when the value changes faster than this,
+                      in unit per second
+        :param count: The number of successive samples the condition must
+                      hold for
+    """
+    def __init__(self, event, above=None, below=None, slope=None, count=1):
+        self.event = event
+        self.above = above
+        self.below = below
+        self.slope = slope
+        self.count = count
+        self.hits = 0
+        self.armed = True
+        self.last = None
+
+    def _condition(self, timestamp, value):
+        if self.above is not None and value > self.above:
+            return True
+        if self.below is not None and value < self.below:
+            return True
+        if self.slope is not None and self.last is not None:
+            last_timestamp, last_value = self.last
+            elapsed = timestamp - last_timestamp
+            if elapsed > 0 and \
+               abs(value - last_value) / elapsed > self.slope:
+                return True
+        return False
+
+    def check(self, timestamp, value):
+        """
+            Check the condition with a new value
+
+            :param timestamp: The time of the value, in seconds
+            :param value: The value of the event
+            :return: True if the trigger fires
+        """
+        if value is None:
+            return False
+        condition = self._condition(timestamp, value)
+        self.last = (timestamp, value)
+        if not condition:
+            self.hits = 0
+            self.armed = True
+            return False
+        self.hits += 1
+        if self.armed and self.hits >= self.count:
+            self.armed = False
+            return True
+        return False
+
+    def reset(self):
+        """
+            Arm the trigger again, and forget the previous values
+        """
+        self.hits = 0
+        self.armed = True
+        self.last = None
+
+class TriggeredCapture:
+    """
+        A class saving the samples around each trigger
+
+        The samples of all the sampled events are kept, from the oldest
+        kept sample of the trigger event to the post_samples-th sample
+        taken after the trigger. As the events of a sample are received
+        one by one, a window is saved on the first value of the next
+        sample, or by flush(). The rates are set with Sampler.set_rate(),
+        so an adaptive sampler never samples slower than them.
+        :param sampler: The Sampler object providing the event values
+        :param trigger: The Trigger object
+        :param pre_samples: The number of samples kept before the trigger
+        :param post_samples: The number of samples taken after the trigger
+        :param rate: The sampling rate around a trigger, in Hz
+        :param background_rate: The sampling rate between triggers, in Hz
+        :param output: A function called with the trigger timestamp and a
+                       dictionary of list of tuple of timestamp and value,
+                       indexed by PerfEvent object. By default, windows
+                       are appended to windows.
+    """
+    def __init__(self, sampler, trigger, pre_samples=100, post_samples=100,
+                 rate=100.0, background_rate=1.0, output=None):
+        self.sampler = sampler
+        self.trigger = trigger
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.rate = rate
+        self.background_rate = background_rate
+        self.output = output or self._store
+        self.windows = []
+        self.history = {}
+        self.window = None
+        self.trigger_timestamp = None
+        self.end_timestamp = None
+        self.remaining = 0
+        sampler.set_rate(background_rate)
+        sampler.add_listener(self.add)
+
+    def _store(self, timestamp, window):
+        self.windows.append((timestamp, window))
+
+    def triggered(self):
+        """
+            Return True if a window is being captured
+
+            :return: True after the trigger fired, until the window is saved
+        """
+        return self.window is not None
+
+    def _start(self, timestamp):
+        start = self.history[self.trigger.event][0][0]
+        self.trigger_timestamp = timestamp
+        self.remaining = self.post_samples
+        self.window = {event: [sample for sample in history
+                               if sample[0] >= start]
+                       for event, history in self.history.items()}
+        for history in self.history.values():
+            history.clear()
+        self.sampler.set_rate(self.rate)
+        if self.remaining <= 0:
+            self._end(timestamp)
+
+    def _end(self, timestamp):
+        self.end_timestamp = timestamp
+        self.sampler.set_rate(self.background_rate)
+
+    def _finish(self):
+        window = self.window
+        self.window = None
+        self.end_timestamp = None
+        self.sampler.set_rate(self.background_rate)
+        self.output(self.trigger_timestamp, window)
+
+    def add(self, event, timestamp, value):
+        """
+            Handle a new value
+
+            :param event: The PerfEvent object
+            :param timestamp: The time of the value, in seconds
+            :param value: The value of the event
+        """
+        if self.end_timestamp is not None and timestamp > self.end_timestamp:
+            self._finish()
+        if self.window is not None:
+            self.window.setdefault(event, []).append((timestamp, value))
+        else:
+            history = self.history.get(event)
+            if history is None:
+                history = deque(maxlen=self.pre_samples + 1)
+                self.history[event] = history
+            history.append((timestamp, value))
+
+        if event is not self.trigger.event:
+            return
+        fired = self.trigger.check(timestamp, value)
+        if self.window is None:
+            if fired:
+                self._start(timestamp)
+        elif self.end_timestamp is None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self._end(timestamp)
+
+    def flush(self):
+        """
+            Save the window being captured, even if it is not complete
+        """
+        if self.window is not None:
+            self._finish()
+
+    def close(self):
+        """
+            Stop receiving values from the sampler
+        """
+        self.sampler.remove_listener(self.add)
+        self.flush()
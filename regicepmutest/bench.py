@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# MIT License
+#
+# Copyright (c) 2018 BayLibre
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Benchmarks of the PMU operations.
+
+    This counts the register transactions and measures the wall time of
+    the PMU operations, using RegiceClientTest with a configurable latency
+    per transaction. The bench PMU registers are a fake register bank:
+    counters are neighbours, so snapshots can read them in blocks.
+"""
+
+import argparse
+import sys
+import time
+import warnings
+from types import SimpleNamespace
+
+from libregice.regiceclienttest import RegiceClientTest
+from libregice.device import Device
+from regicetest import open_svd_file
+from svd import SVDText
+
+from regicepmu.perf import Perf, PerfEvent
+from regicepmu.pmu import PMU, PMUCounter
+
+class LatencyRegiceClientTest(RegiceClientTest):
+    """
+        A test client counting the memory transactions, and adding a latency
+
+        A block read is a single read transaction.
+        :param latency: The latency of each transaction, in seconds
+    """
+    def __init__(self, latency=0.0):
+        super(LatencyRegiceClientTest, self).__init__()
+        self.latency = latency
+        self.read_count = 0
+        self.write_count = 0
+
+    def read(self, width, address):
+        self.read_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return super(LatencyRegiceClientTest, self).read(width, address)
+
+    def write(self, width, address, value):
+        self.write_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return super(LatencyRegiceClientTest, self).write(width, address, value)
+
+    def read_block(self, width, address, count):
+        self.read_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.memory.get(address + i * width // 8, 0)
+                for i in range(count)]
+
+class BenchRegister:
+    """
+        A register of a fake register bank, outside of the SVD
+
+        Accesses go through the regice client, so they are counted and
+        delayed as any register access.
+        :param client: The regice client
+        :param name: The name of the register
+        :param address: The address of the register
+        :param width: The width of the register, in bits
+    """
+    COUNTERS_BASE = 0x80000000
+    CONTROLS_BASE = 0x80001000
+
+    def __init__(self, client, name, address, width=32):
+        self.client = client
+        self.name = name
+        self.address = address
+        self.svd = SimpleNamespace(bitWidth=width)
+        client.memory[address] = 0
+
+    def read(self):
+        return self.client.read(self.svd.bitWidth, self.address)
+
+    def write(self, value):
+        return self.client.write(self.svd.bitWidth, self.address, value)
+
+    def __int__(self):
+        return self.read()
+
+class BenchPMUCounter(PMUCounter):
+    """
+        A counter with its own enable and event select registers
+    """
+    def __init__(self, pmu, register, control, select):
+        super(BenchPMUCounter, self).__init__(pmu, register, support_event=True)
+        self.control = control
+        self.select = select
+
+    def _enable(self):
+        self.control.write(1)
+
+    def _disable(self):
+        self.control.write(0)
+
+    def _enabled(self):
+        return bool(int(self.control))
+
+    def _set_event(self, event_id):
+        self.select.write(event_id)
+        return True
+
+    def _get_event(self):
+        return int(self.select)
+
+class BenchPMU(PMU):
+    """
+        A PMU with a configurable number of event counters
+
+        The PMU and each counter have their own control registers.
+    """
+    def __init__(self, device, name, counters_count):
+        super(BenchPMU, self).__init__(device, name)
+        client = device.client
+        base = BenchRegister.CONTROLS_BASE
+        self.control = BenchRegister(client, 'PMCR', base)
+        for i in range(counters_count):
+            register = BenchRegister(client, 'CNT{}'.format(i),
+                                     BenchRegister.COUNTERS_BASE + 4 * i)
+            control = BenchRegister(client, 'CNTEN{}'.format(i),
+                                    base + 8 * i + 8)
+            select = BenchRegister(client, 'EVTSEL{}'.format(i),
+                                   base + 8 * i + 12)
+            BenchPMUCounter(self, register, control, select)
+        self.events = {i: ['event{}'.format(i), '']
+                       for i in range(max(64, 2 * counters_count))}
+
+    def _enable(self):
+        self.control.write(1)
+
+    def _disable(self):
+        self.control.write(0)
+
+    def _enabled(self):
+        return bool(int(self.control))
+
+    def pause(self):
+        self.control.write(0)
+
+    def resume(self):
+        self.control.write(1)
+
+    def reset(self):
+        for counter in self.counters.values():
+            counter.register.write(0)
+
+class BenchPerfEvent(PerfEvent):
+    """
+        A perf event computed from one counter
+    """
+    def __init__(self, pmu, name, counter):
+        super(BenchPerfEvent, self).__init__(pmu, Perf.CPU_LOAD, name)
+        self.counters = [counter]
+
+    @classmethod
+    def compute(cls, inputs):
+        return inputs[0] / 2
+
+class Benchmark:
+    """
+        A class to run the benchmarks and report the results
+
+        :param latency: The latency of each memory access, in seconds
+        :param iterations: The number of times each operation is run
+    """
+    def __init__(self, latency=0.0, iterations=100):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = LatencyRegiceClientTest(latency)
+        self.dev = Device(svd, self.client)
+        self.iterations = iterations
+        self.results = []
+
+    def setup(self, counters_count):
+        """
+            Create a PMU, with one perf event per counter
+
+            :param counters_count: The number of counters of the PMU
+            :return: A tuple of PMU and Perf objects
+        """
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        pmu = BenchPMU(self.dev, 'bench', counters_count)
+        for counter in list(pmu.counters.values()):
+            BenchPerfEvent(pmu, str(counter.register.name), counter)
+        return pmu, Perf(self.dev)
+
+    def measure(self, name, events, function, setup=None):
+        """
+            Measure an operation
+
+            :param name: The name of the operation
+            :param events: The number of events involved in the operation
+            :param function: The function running the operation once
+            :param setup: A function run before each iteration, not measured
+        """
+        reads = 0
+        writes = 0
+        elapsed = 0.0
+        for _ in range(self.iterations):
+            if setup:
+                setup()
+            self.client.read_count = 0
+            self.client.write_count = 0
+            start = time.perf_counter()
+            function()
+            elapsed += time.perf_counter() - start
+            reads += self.client.read_count
+            writes += self.client.write_count
+        self.results.append((name, events, reads / self.iterations,
+                             writes / self.iterations,
+                             elapsed / self.iterations))
+
+    def run(self, events_counts=(1, 2, 4, 8)):
+        """
+            Run all the benchmarks
+
+            :param events_counts: The number of events to benchmark with
+        """
+        for count in events_counts:
+            pmu, perf = self.setup(count)
+            counters = list(pmu.counters.values())
+            event_ids = list(range(count))
+            events = list(perf.get_events())
+
+            def release():
+                for counter in counters:
+                    if counter.allocated:
+                        pmu.disable_event(counter)
+
+            def enable_events():
+                for event_id in event_ids:
+                    pmu.enable_event(event_id)
+
+            self.measure('enable_event', count, enable_events, release)
+            self.measure('enable_events', count,
+                         lambda: pmu.enable_events(event_ids), release)
+            self.measure('configure', count,
+                         lambda: pmu.configure(event_ids), release)
+            self.measure('configure (unchanged)', count,
+                         lambda: pmu.configure(event_ids))
+            release()
+
+            offset = [0]
+
+            def rotate_events():
+                offset[0] = count - offset[0]
+
+            self.measure('set_event', count,
+                         lambda: [counter.set_event(i + offset[0])
+                                  for i, counter in enumerate(counters)],
+                         rotate_events)
+            self.measure('set_event (unchanged)', count,
+                         lambda: [counter.set_event(i + offset[0])
+                                  for i, counter in enumerate(counters)])
+            self.measure('PMU.read', count,
+                         lambda: [pmu.read(counter.register.name)
+                                  for counter in counters])
+            self.measure('PMU.snapshot', count,
+                         lambda: pmu.snapshot([counter.register.name
+                                               for counter in counters]))
+            self.measure('Perf.get_value', count,
+                         lambda: [perf.get_value(Perf.CPU_LOAD, event.name)
+                                  for event in events])
+            self.measure('Perf.get_values', count,
+                         lambda: perf.get_values(events))
+
+    def report(self, file=sys.stdout):
+        """
+            Print the results
+
+            :param file: The file to print the results to
+        """
+        print("{:<24} {:>6} {:>10} {:>10} {:>12}".format(
+            'operation', 'events', 'reads', 'writes', 'time (us)'), file=file)
+        for name, events, reads, writes, elapsed in self.results:
+            print("{:<24} {:>6} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+                name, events, reads, writes, elapsed * 1e6), file=file)
+
+def run_bench(argv=None):
+    """
+        Run the benchmarks from the command line
+
+        :param argv: The command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark PMU operations')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='latency of each memory access, in seconds')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='number of times each operation is run')
+    parser.add_argument('--events', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='number of events to benchmark with')
+    args = parser.parse_args(argv)
+
+    bench = Benchmark(args.latency, args.iterations)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        bench.run(args.events)
+    bench.report()
+    return bench
+
+if __name__ == '__main__':
+    run_bench()
@@ -23,32 +23,57 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import math
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from libregice.regiceclienttest import RegiceClientTest
 from libregice.device import Device
 from regicetest import open_svd_file
 from svd import SVDText
 
+from regicepmu.aggregate import *
+from regicepmu.capture import *
+from regicepmu.collector import *
+from regicepmu.group import *
+from regicepmu.history import *
+from regicepmu.metric import *
+from regicepmu.multiplexer import *
 from regicepmu.perf import *
+from regicepmu.periodic import *
 from regicepmu.pmu import *
+from regicepmu.replay import *
+from regicepmu.trace import *
+from regicepmu.trigger import *
 
 class TestPMUCounter(PMUCounter):
     def __init__(self, pmu, register):
         super(TestPMUCounter, self).__init__(pmu, register, support_event=True)
         self.en = False
+        self.writes = 0
 
     def _enable(self):
+        self.writes += 1
         self.en = True
 
     def _disable(self):
+        self.writes += 1
         self.en = False
 
     def _enabled(self):
         return self.en
 
     def _set_event(self, event_id):
-        pass
+        self.writes += 1
 
 class TestPMU(PMU):
     def __init__(self, device, name):
@@ -74,10 +99,56 @@ class TestPMU(PMU):
         self.device.TEST1.TESTA.write(0)
         self.device.TEST1.TESTB.write(0)
 
+class CorePMU(TestPMU):
+    def __init__(self, device, name, registers):
+        PMU.__init__(self, device, name)
+        self.en = False
+        self.paused = False
+        for register in registers:
+            PMUCounter(self, register)
+
+class BlockRegiceClientTest(RegiceClientTest):
+    def __init__(self):
+        super(BlockRegiceClientTest, self).__init__()
+        self.reads = 0
+        self.block_reads = 0
+
+    def read(self, width, address):
+        self.reads += 1
+        return super(BlockRegiceClientTest, self).read(width, address)
+
+    def read_block(self, width, address, count):
+        self.block_reads += 1
+        return [self.read(width, address + i * width // 8)
+                for i in range(count)]
+
+class GrowingRegiceClientTest(RegiceClientTest):
+    def read(self, width, address):
+        value = super(GrowingRegiceClientTest, self).read(width, address) + 1
+        self.memory[address] = value
+        time.sleep(0)
+        return value
+
+class CaptureStub:
+    counters = [{'name': 'TESTA', 'width': 32}]
+    events = {}
+
+    def read(self):
+        yield 0.0, (0,)
+
 class TestPerfEvent(PerfEvent):
     def get_value(self):
         return self.pmu.device.TEST1.TESTA / self.pmu.device.TEST1.TESTB
 
+class TestRatioPerfEvent(PerfEvent):
+    def __init__(self, pmu, name, counters):
+        super(TestRatioPerfEvent, self).__init__(pmu, Perf.CPU_LOAD, name)
+        self.counters = counters
+
+    @classmethod
+    def compute(cls, inputs):
+        return 100 * inputs[0] / inputs[1]
+
 class PMUCounterTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -115,6 +186,65 @@ class PMUCounterTestCase(unittest.TestCase):
     def test_str(self):
         self.assertEqual(str(self.counter), 'TESTA')
 
+    def test_shadow(self):
+        self.counter.enable()
+        self.counter.enable()
+        self.assertEqual(self.counter.writes, 1)
+        self.assertTrue(self.counter.enabled())
+
+        self.counter.en = False
+        self.assertTrue(self.counter.enabled())
+        self.counter.resync()
+        self.assertFalse(self.counter.enabled())
+        self.counter.disable()
+        self.assertEqual(self.counter.writes, 1)
+
+    def test_shadow_event(self):
+        self.counter.support_event = True
+        self.counter.pmu.events = {0: ['test', 'test']}
+        self.counter.set_event(0)
+        self.counter.set_event(0)
+        self.assertEqual(self.counter.writes, 1)
+        self.assertEqual(self.counter.event_id, 0)
+
+    def test_read_virtual(self):
+        width = self.counter.width
+        self.dev.TEST1.TESTA.write((1 << width) - 2)
+        self.assertEqual(self.counter.read_virtual(), (1 << width) - 2)
+
+        self.dev.TEST1.TESTA.write(3)
+        self.assertEqual(self.counter.read_virtual(), (1 << width) + 3)
+        self.assertEqual(self.counter.wraps, 1)
+
+        self.dev.TEST1.TESTA.write(5)
+        self.assertEqual(self.counter.read(), 5)
+        self.assertEqual(self.counter.virtual, (1 << width) + 5)
+
+        self.counter.reset_virtual()
+        self.assertEqual(self.counter.read_virtual(), 5)
+        self.assertEqual(self.counter.wraps, 0)
+
+    def test_read_concurrent(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        dev = Device(svd, GrowingRegiceClientTest())
+        pmu = TestPMU(dev, 'test')
+        counter = pmu.counters['TESTA']
+        dev.TEST1.TESTA.write(0)
+
+        def reads():
+            for _ in range(300):
+                counter.read()
+        threads = [threading.Thread(target=reads) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.wraps, 0)
+        self.assertEqual(counter.virtual, counter.last_raw)
+        self.assertEqual(counter.virtual, 600)
+
 class PMUTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -138,10 +268,26 @@ class PMUTestCase(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             self.not_implemented_pmu.enable()
 
+    def test_reset_virtual(self):
+        counter = self.pmu.counters['TESTA']
+        self.assertEqual(counter.read_virtual(), 0x100003)
+        self.pmu.reset()
+        self.assertEqual(counter.read_virtual(), 0)
+        self.assertEqual(counter.wraps, 0)
+        self.dev.TEST1.TESTA.write(7)
+        self.assertEqual(counter.read_virtual(), 7)
+
     def test_disable(self):
         self.pmu.disable()
         self.assertFalse(self.pmu.en)
 
+        self.pmu.en = True
+        self.pmu.disable()
+        self.assertTrue(self.pmu.en)
+        self.pmu.resync()
+        self.pmu.disable()
+        self.assertFalse(self.pmu.en)
+
         with self.assertRaises(NotImplementedError):
             self.not_implemented_pmu.disable()
 
@@ -181,6 +327,50 @@ class PMUTestCase(unittest.TestCase):
         TESTB = self.pmu.read('TESTB')
         self.assertEqual(TESTB, 0x10000)
 
+    def test_stats(self):
+        self.assertEqual(self.pmu.stats(), None)
+        self.pmu.enable_stats()
+        self.pmu.read('TESTA')
+        self.pmu.read('TESTA')
+        self.pmu.pause()
+        self.pmu.resume()
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTB).read()
+
+        stats = self.pmu.stats()
+        width = self.pmu.counters['TESTA'].width
+        self.assertEqual(stats[('TESTA', 'read', None)]['count'], 2)
+        self.assertEqual(stats[('TESTA', 'read', None)]['bytes'],
+                         2 * width // 8)
+        self.assertEqual(sum(stats[('TESTA', 'read', None)]['histogram']), 2)
+        self.assertEqual(stats[('test', 'pause', None)]['count'], 1)
+        self.assertEqual(stats[('TESTB', 'read', None)]['count'], 1)
+
+        self.pmu.disable_stats()
+        self.assertNotIn('read', self.pmu.counters['TESTA'].__dict__)
+        self.assertNotIn('pause', self.pmu.__dict__)
+        self.assertEqual(self.pmu.stats(), None)
+
+    def test_stats_shared_client(self):
+        width = self.pmu.counters['TESTA'].width
+        other = CorePMU(self.dev, 'other', [self.dev.TEST1.TESTC])
+        self.pmu.enable_stats()
+        other.enable_stats()
+        self.pmu.read('TESTA')
+        other.disable_stats()
+        self.pmu.read('TESTA')
+        stats = self.pmu.stats()
+        self.assertEqual(stats[('TESTA', 'read', None)]['bytes'],
+                         2 * width // 8)
+        self.pmu.disable_stats()
+        self.assertNotIn('read', self.client.__dict__)
+
+    def test_stats_caller(self):
+        self.pmu.enable_stats(caller=True)
+        self.pmu.read('TESTA')
+        callers = [key[2] for key in self.pmu.stats()]
+        self.assertTrue(callers[0].endswith(':read'))
+        self.pmu.disable_stats()
+
     def test_enable_event(self):
         self.pmu.events = {0: ['test', 'test']}
         TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
@@ -192,9 +382,63 @@ class PMUTestCase(unittest.TestCase):
         cnt = self.pmu.enable_event(0)
         self.assertEqual(cnt, self.pmu.get_counters()['TESTB'])
 
-        with self.assertRaises(Exception):
+        with self.assertRaises(CounterAllocationError):
             cnt = self.pmu.enable_event(0)
 
+    def test_enable_event_constraint(self):
+        self.pmu.events = {0: ['test', 'test'], 1: ['test1', 'test1']}
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTB)
+        self.pmu.set_event_counters(1, ['TESTB'])
+
+        cnt = self.pmu.enable_event(1)
+        self.assertEqual(cnt, self.pmu.get_counters()['TESTB'])
+        with self.assertRaises(CounterAllocationError):
+            self.pmu.enable_event(1)
+
+    def test_enable_events(self):
+        self.pmu.events = {0: ['test', 'test'], 1: ['test1', 'test1']}
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTB)
+        self.pmu.set_event_counters(1, ['TESTA'])
+
+        counters = self.pmu.enable_events([0, 1])
+        self.assertEqual(counters, [self.pmu.get_counters()['TESTB'],
+                                    self.pmu.get_counters()['TESTA']])
+        self.assertEqual(self.pmu.free_mask, 0)
+
+        for counter in counters:
+            self.pmu.disable_event(counter)
+        with self.assertRaises(CounterAllocationError):
+            self.pmu.enable_events([1, 1])
+        self.assertTrue(all(not counter.allocated
+                            for counter in self.pmu.counters.values()))
+
+    def test_configure(self):
+        self.pmu.events = {0: ['test', 'test'], 1: ['test1', 'test1'],
+                           2: ['test2', 'test2']}
+        cnta = TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
+        cntb = TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTB)
+
+        self.assertEqual(self.pmu.configure([0, 1]), [cnta, cntb])
+        self.assertTrue(cnta.en and cntb.en)
+        writes = cnta.writes
+
+        self.assertEqual(self.pmu.configure([2, 0]), [cntb, cnta])
+        self.assertEqual(cnta.writes, writes)
+        self.assertEqual(cntb.event_id, 2)
+        self.assertTrue(cntb.en)
+
+        self.pmu.set_event_counters(1, ['TESTA'])
+        self.assertEqual(self.pmu.configure([0, 1]), [cntb, cnta])
+
+        self.assertEqual(self.pmu.configure([2]), [cnta])
+        self.assertFalse(cntb.en or cntb.allocated)
+
+        with self.assertRaises(CounterAllocationError):
+            self.pmu.configure([1, 1])
+        self.assertEqual(cnta.event_id, 2)
+
     def test_disable_event(self):
         self.pmu.events = {0: ['test', 'test']}
         TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
@@ -206,6 +450,842 @@ class PMUTestCase(unittest.TestCase):
         self.pmu.disable_event(cnt)
         self.assertFalse(cnt.allocated)
 
+class AggregateTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        self.perf_event = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test')
+        self.perf = Perf(self.dev)
+
+    def test_window(self):
+        stats = WindowedStats(3, (0, 10), bins=10)
+        self.assertEqual(stats.mean(), None)
+        self.assertEqual(stats.min(), None)
+        self.assertEqual(stats.quantile(0.5), None)
+        for timestamp, value in enumerate([5, 1, 7, 3, None, 2]):
+            stats.add(timestamp, value)
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats.mean(), 2.5)
+        self.assertEqual(stats.variance(), 0.25)
+        self.assertEqual(stats.min(), 2)
+        self.assertEqual(stats.max(), 3)
+
+        stats.add(6, 9)
+        self.assertEqual(stats.min(), 2)
+        self.assertEqual(stats.max(), 9)
+        stats.add(10, 4)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats.min(), 4)
+        self.assertEqual(stats.max(), 4)
+
+    def test_window_precision(self):
+        stats = WindowedStats(3, (0, 10), bins=10)
+        for timestamp, value in enumerate([0.1, 0.7, 0.3, 0, 0, 0]):
+            stats.add(timestamp, value)
+        self.assertEqual(stats.mean(), 0)
+        self.assertEqual(stats.variance(), 0)
+
+        stats = WindowedStats(1000, (0, 10), bins=10)
+        for timestamp in range(300):
+            stats.add(timestamp, 1e8 + timestamp % 3)
+        self.assertAlmostEqual(stats.mean(), 1e8 + 1)
+        self.assertAlmostEqual(stats.variance(), 2 / 3)
+
+    def test_quantile(self):
+        stats = WindowedStats(1000, (0, 100), bins=100)
+        for value in range(100):
+            stats.add(value, value + 0.5)
+        self.assertEqual(stats.quantile(0.5), 50)
+        self.assertEqual(stats.quantile(0.99), 99)
+        self.assertEqual(stats.quantile(1), 100)
+        stats.add(100, 1000)
+        self.assertEqual(stats.quantile(1), 100)
+
+    def test_aggregator(self):
+        sampler = Sampler(self.perf, [self.perf_event])
+        aggregator = Aggregator(sampler)
+        with self.assertRaises(ValueError):
+            aggregator.watch(self.perf_event, 10)
+        stats = aggregator.watch(self.perf_event, 10, (0, 100))
+        self.assertEqual((stats.low, stats.high), (0, 100))
+        self.perf_event.yrange = [0, 50]
+        self.assertEqual(aggregator.watch(self.perf_event, 10).high, 50)
+        sampler.sample()
+        sampler.sample()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats.mean(), self.perf_event.get_value())
+
+        aggregator.close()
+        sampler.sample()
+        self.assertEqual(len(stats), 2)
+
+@unittest.skipIf(numpy is None, "NumPy is not available")
+class CaptureTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.pmu = TestPMU(self.dev, 'test')
+        self.pmu.events = {0: ['test', 'test']}
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_capture(self):
+        with CaptureWriter(self.path, self.pmu) as writer:
+            snapshot = self.pmu.snapshot()
+            writer.write_snapshot(snapshot)
+            start = snapshot.timestamp
+            for i in range(1, 10):
+                writer.write(start + i, [i, 2 * i])
+
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(reader.pmu_name, 'test')
+            self.assertEqual(reader.counter_names, ['TESTA', 'TESTB'])
+            self.assertEqual(reader.events, {0: ['test', 'test']})
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(reader.counter('TESTA')[0], 0x100003)
+
+            records = reader.time_slice(start + 3, start + 6)
+            self.assertEqual(len(records), 3)
+            self.assertEqual(list(reader.counter('TESTB', records)),
+                             [6, 8, 10])
+            self.assertFalse(records.flags.owndata)
+            del records
+
+    def test_invalid(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'invalid capture file')
+        with self.assertRaises(CaptureError):
+            CaptureReader(self.path)
+
+        open(self.path, 'wb').close()
+        with self.assertRaises(CaptureError):
+            CaptureReader(self.path)
+
+    def test_close_in_use(self):
+        with CaptureWriter(self.path, self.pmu) as writer:
+            writer.write_snapshot(self.pmu.snapshot())
+        reader = CaptureReader(self.path)
+        records = reader.time_slice()
+        with self.assertWarns(UserWarning):
+            reader.close()
+        del records
+
+class TraceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.pmu = TestPMU(self.dev, 'test')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_encode_chunk(self):
+        records = [(10, 0xffffffff, 5), (20, 3, 5), (35, 2, 1 << 40)]
+        data = encode_chunk(records)
+        self.assertEqual(decode_chunk(data, 3, 3), records)
+
+    def test_trace(self):
+        with TraceWriter(self.path, self.pmu, chunk_size=4) as writer:
+            for i in range(10):
+                writer.write(i, [100 + i, 0xffffffff - i])
+            self.assertEqual(len(writer.index), 2)
+            self.assertEqual(len(writer.records), 2)
+
+        with TraceReader(self.path) as reader:
+            self.assertEqual(reader.counter_names, ['TESTA', 'TESTB'])
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(len(list(reader.read())), 10)
+
+            reads = []
+            reader._read_chunk = lambda entry, read=reader._read_chunk: \
+                reads.append(entry) or read(entry)
+            records = list(reader.read(5, 7))
+            self.assertEqual(records, [(5.0, (105, 0xffffffff - 5)),
+                                       (6.0, (106, 0xffffffff - 6))])
+            self.assertEqual(len(reads), 1)
+
+    def test_invalid(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'invalid trace file')
+        with self.assertRaises(TraceError):
+            TraceReader(self.path)
+
+class ReplayTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.pmu = TestPMU(self.dev, 'test')
+        self.pmu.events = {0: ['test', 'test']}
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        with TraceWriter(self.path, self.pmu) as writer:
+            for i in range(5):
+                writer.write(i, [100 * (i + 1), 10 * (i + 1)])
+        self.reader = TraceReader(self.path)
+        self.now = 0.0
+
+    def tearDown(self):
+        self.reader.close()
+        os.remove(self.path)
+
+    def clock(self):
+        return self.now
+
+    def test_replay(self):
+        pmu = ReplayPMU(ReplayDevice(), 'test', self.reader,
+                        advance_on='pause')
+        self.assertEqual(pmu.events, {0: ['test', 'test']})
+        self.assertEqual(pmu.read('TESTA'), 100)
+        pmu.pause()
+        self.assertEqual(pmu.read('TESTA'), 100)
+
+        pmu.pause()
+        self.assertTrue(pmu.paused)
+        self.assertEqual(pmu.snapshot().values, {'TESTA': 200, 'TESTB': 20})
+        pmu.resume()
+        self.assertFalse(pmu.paused)
+
+        pmu.reset()
+        pmu.pause()
+        self.assertEqual(pmu.read('TESTA'), 100)
+        for _ in range(3):
+            pmu.pause()
+        self.assertTrue(pmu.finished)
+
+        with self.assertRaises(ValueError):
+            ReplayPMU(ReplayDevice(), 'test', self.reader, advance_on='read')
+
+    def test_replay_tick(self):
+        device = ReplayDevice()
+        pmu = ReplayPMU(device, 'test', self.reader)
+        event = TestRatioPerfEvent(pmu, 'test', [pmu.counters['TESTA'],
+                                                 pmu.counters['TESTB']])
+        perf = Perf(device)
+        sampler = Sampler(perf, [event])
+        for _ in range(3):
+            sampler.sample()
+        self.assertEqual([raws for _, raws, _ in sampler.get_samples(event)],
+                         [(100, 10), (200, 20), (300, 30)])
+        self.assertEqual(perf.get_values([event]), {event: 1000})
+        self.assertEqual(pmu.read('TESTA'), 400)
+
+        pmu = ReplayPMU(ReplayDevice(), 'test', self.reader,
+                        advance_on='snapshot')
+        self.assertEqual([pmu.snapshot()['TESTB'] for _ in range(2)],
+                         [10, 20])
+
+        pmu.rewind()
+        self.assertEqual(pmu.read('TESTA'), 100)
+
+    def test_replay_realtime(self):
+        pmu = ReplayPMU(ReplayDevice(), 'test', self.reader, realtime=True,
+                        clock=self.clock)
+        self.assertEqual(pmu.read('TESTA'), 100)
+        self.now = 2.5
+        self.assertEqual(pmu.read('TESTA'), 300)
+        pmu.pause()
+        self.now = 10.0
+        self.assertEqual(pmu.read('TESTA'), 300)
+        pmu.resume()
+        self.now = 11.0
+        self.assertEqual(pmu.read('TESTA'), 400)
+
+    def test_replay_events(self):
+        pmu = TestPMU(self.dev, 'events')
+        pmu.events = {0: ['test0', ''], 1: ['test1', ''], 2: ['test2', '']}
+        counter_a = TestPMUCounter(pmu, self.dev.TEST1.TESTC)
+        counter_b = TestPMUCounter(pmu, self.dev.TEST1.TESTD)
+        counter_a.set_event(1)
+        counter_b.set_event(0)
+        path = self.path + '.events'
+        with TraceWriter(path, pmu, ['TESTC', 'TESTD']) as writer:
+            writer.write(0, [5, 7])
+        reader = TraceReader(path)
+        try:
+            replay = ReplayPMU(ReplayDevice(), 'test', reader)
+            counter = replay.enable_event(0)
+            self.assertEqual(counter.register.name, 'TESTD')
+            self.assertEqual(counter.read(), 7)
+            self.assertEqual(replay.enable_event(1).register.name, 'TESTC')
+            with self.assertRaises(CounterAllocationError):
+                replay.enable_event(2)
+        finally:
+            reader.close()
+            os.remove(path)
+
+    def test_replay_perf_event(self):
+        device = ReplayDevice()
+        pmu = ReplayPMU(device, 'test', self.reader)
+        counters = pmu.counters
+        event = TestRatioPerfEvent(pmu, 'test',
+                                   [counters['TESTB'], counters['TESTA']])
+        perf = Perf(device)
+        event.enable()
+        self.assertTrue(pmu.enabled())
+        self.assertEqual(perf.get_value(Perf.CPU_LOAD, 'test'), 10)
+
+class HistoryTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        self.perf_event = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test')
+        self.perf = Perf(self.dev)
+
+    def test_levels(self):
+        history = History(resolution=1.0, factor=10, levels=2)
+        for i in range(200):
+            history.add(i * 0.1, i % 10)
+        history.add(20.0, None)
+        self.assertEqual(len(history), 200)
+
+        envelope = history.envelope(0, 20, 1000)
+        self.assertEqual(len(envelope), 200)
+        self.assertEqual(envelope[3], (0.30000000000000004, 3, 3, 3))
+
+        envelope = history.envelope(0, 20, 50)
+        self.assertEqual(len(envelope), 20)
+        self.assertEqual(envelope[0], (0.0, 0, 9, 4.5))
+
+        envelope = history.envelope(0, 20, 5)
+        self.assertEqual(len(envelope), 2)
+        self.assertEqual(envelope[1], (10.0, 0, 9, 4.5))
+
+        envelope = history.envelope(5.5, 7.5, 5)
+        self.assertEqual([bucket[0] for bucket in envelope], [5.0, 6.0, 7.0])
+
+    def test_lttb(self):
+        points = [(i, 0) for i in range(100)]
+        points[42] = (42, 10)
+        decimated = lttb(points, 10)
+        self.assertEqual(len(decimated), 10)
+        self.assertEqual(decimated[0], points[0])
+        self.assertEqual(decimated[-1], points[-1])
+        self.assertIn((42, 10), decimated)
+        self.assertEqual(lttb(points[:5], 10), points[:5])
+        self.assertEqual(lttb(points, 2), [points[0], points[-1]])
+        self.assertEqual(lttb(points, 1), [points[0]])
+        self.assertEqual(lttb(points, 0), [])
+
+    def test_query(self):
+        history = History(resolution=1.0, factor=10, levels=3)
+        for i in range(10000):
+            history.add(i * 0.01, i % 100)
+        points = history.query(0, 100, 30)
+        self.assertEqual(len(points), 30)
+        self.assertEqual(points[0], (0.0, 49.5))
+        self.assertEqual(len(history.query(0, 100, 20)), 20)
+
+    def test_truncated(self):
+        history = History(capacity=100)
+        for i in range(1000):
+            history.add(i, i % 7)
+        envelope = history.envelope(0, 200, 50)
+        self.assertEqual(len(envelope), 21)
+        self.assertEqual(envelope[0], (0, 0, 6, 2.4))
+        self.assertEqual(len(history.envelope(950, 999, 50)), 50)
+        self.assertEqual(len(history.query(0, 999, 50)), 50)
+        self.assertEqual(len(history.query(0, 999, 2)), 2)
+        self.assertEqual(len(history.query(0, 999, 1)), 1)
+
+    def test_recorder(self):
+        sampler = Sampler(self.perf, [self.perf_event])
+        recorder = HistoryRecorder(sampler)
+        history = recorder.watch(self.perf_event, resolution=0.5)
+        self.assertIs(recorder.watch(self.perf_event), history)
+        sampler.sample()
+        self.assertEqual(len(history), 1)
+        recorder.close()
+        sampler.sample()
+        self.assertEqual(len(history), 1)
+
+class TriggerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        self.perf_event1 = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test1')
+        self.perf_event2 = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test2')
+        self.perf = Perf(self.dev)
+
+    def test_trigger(self):
+        trigger = Trigger(self.perf_event1, above=95, count=2)
+        fired = [trigger.check(i, value)
+                 for i, value in enumerate([96, 50, 96, 97, 98, 10, 99, 99])]
+        self.assertEqual(fired, [False, False, False, True, False,
+                                 False, False, True])
+
+        trigger = Trigger(self.perf_event1, slope=10)
+        fired = [trigger.check(i * 0.5, value)
+                 for i, value in enumerate([0, 4, 10, 12, None, 11])]
+        self.assertEqual(fired, [False, False, True, False, False, False])
+
+    def test_capture(self):
+        sampler = Sampler(self.perf, [self.perf_event1, self.perf_event2])
+        trigger = Trigger(self.perf_event1, above=95)
+        capture = TriggeredCapture(sampler, trigger, pre_samples=2,
+                                   post_samples=2, rate=100.0,
+                                   background_rate=2.0)
+        self.assertEqual(sampler.interval, 0.5)
+
+        values = [10, 20, 30, 99, 40, 50, 60]
+        for i, value in enumerate(values[:4]):
+            capture.add(self.perf_event1, i, value)
+            capture.add(self.perf_event2, i, -value)
+        self.assertTrue(capture.triggered())
+        self.assertEqual(sampler.interval, 0.01)
+
+        for i, value in enumerate(values[4:], 4):
+            capture.add(self.perf_event1, i, value)
+            capture.add(self.perf_event2, i, -value)
+        self.assertFalse(capture.triggered())
+        self.assertEqual(sampler.interval, 0.5)
+
+        self.assertEqual(len(capture.windows), 1)
+        timestamp, window = capture.windows[0]
+        self.assertEqual(timestamp, 3)
+        self.assertEqual(window[self.perf_event1],
+                         [(1, 20), (2, 30), (3, 99), (4, 40), (5, 50)])
+        self.assertEqual(window[self.perf_event2],
+                         [(1, -20), (2, -30), (3, -99), (4, -40), (5, -50)])
+
+        capture.add(self.perf_event1, 7, 99)
+        capture.close()
+        self.assertEqual(len(capture.windows), 2)
+        self.assertEqual(capture.windows[1][1][self.perf_event1],
+                         [(6, 60), (7, 99)])
+        self.assertEqual(sampler.listeners, [])
+
+class MetricTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.pmu = TestPMU(self.dev, 'test')
+
+    def test_metric(self):
+        metric = Metric('test', '100 * (TESTA - TESTB) / max(TESTA, 1)')
+        self.assertEqual(metric.names, {'TESTA', 'TESTB'})
+        self.assertEqual(metric.evaluate({'TESTA': 4, 'TESTB': 1}), 75)
+        self.assertEqual(Metric('test', 'a / b').evaluate({'a': 1, 'b': 0}),
+                         None)
+
+        self.assertEqual(Metric('test', '-1.5 * a').evaluate({'a': 2}), -3)
+        for expression in ['a +', '__import__("os")', 'a.b', 'a < b', '"a"',
+                           '2 ** 2 ** 100']:
+            with self.assertRaises(MetricError):
+                Metric('test', expression)
+
+    def test_evaluate(self):
+        metrics = MetricSet(self.pmu, {'ratio': 'TESTA / TESTB',
+                                       'b': 'TESTB'})
+        self.assertEqual(metrics.get_counters(['b']),
+                         [self.pmu.counters['TESTB']])
+        self.assertEqual(metrics.evaluate(),
+                         {'ratio': 0x100003 / 0x10000, 'b': 0x10000})
+
+        metrics.add('unknown', 'TESTC')
+        with self.assertRaises(MetricError):
+            metrics.evaluate()
+
+    def test_evaluate_events(self):
+        self.pmu.events = {0: ['cycles', ''], 1: ['idle', '']}
+        TestPMUCounter(self.pmu, self.dev.TEST1.TESTA)
+        TestPMUCounter(self.pmu, self.dev.TEST1.TESTB)
+        self.pmu.enable_events([0, 1])
+
+        metrics = MetricSet(self.pmu, delta=True)
+        metrics.add('load', '100 * (cycles - event_1) / cycles')
+        self.assertEqual(metrics.evaluate(), {'load': None})
+        self.dev.TEST1.TESTA.write(0x100003 + 100)
+        self.dev.TEST1.TESTB.write(0x10000 + 25)
+        self.assertEqual(metrics.evaluate(), {'load': 75})
+
+    def test_metric_event(self):
+        metrics = MetricSet(self.pmu)
+        event = MetricEvent(metrics, Perf.CPU_LOAD, 'ratio', 'TESTA / TESTB')
+        perf = Perf(self.dev)
+        self.assertEqual(perf.get_value(Perf.CPU_LOAD, 'ratio'),
+                         0x100003 / 0x10000)
+        self.assertEqual(event.get_counters(), [self.pmu.counters['TESTA'],
+                                                self.pmu.counters['TESTB']])
+
+class MultiplexerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.pmu = TestPMU(self.dev, 'test')
+        self.pmu.events = {0: ['test0', ''], 1: ['test1', ''], 2: ['test2', '']}
+        TestPMUCounter(self.pmu, self.dev.TEST1.TESTA)
+        TestPMUCounter(self.pmu, self.dev.TEST1.TESTB)
+        self.dev.TEST1.TESTA.write(0)
+        self.dev.TEST1.TESTB.write(0)
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def add(self, register, value):
+        register.write(int(register) + value)
+
+    def test_rotate(self):
+        mux = Multiplexer(self.pmu, [0, 1, 2], clock=self.clock)
+        mux.start()
+        self.now = 1.0
+        self.add(self.dev.TEST1.TESTA, 10)
+        self.add(self.dev.TEST1.TESTB, 20)
+        mux.rotate()
+        self.now = 2.0
+        self.add(self.dev.TEST1.TESTA, 30)
+        self.add(self.dev.TEST1.TESTB, 40)
+        mux.rotate()
+
+        self.assertEqual(mux.read(0), (50, 0))
+        self.assertEqual(mux.read(1), (40, 20))
+        self.assertEqual(mux.read(2), (60, 30))
+        self.assertEqual(mux.get_event(1).time_enabled, 2.0)
+        self.assertEqual(mux.get_event(1).time_running, 1.0)
+
+        mux.stop()
+        self.assertEqual(self.pmu.free_mask, 3)
+
+    def test_too_large_group(self):
+        mux = Multiplexer(self.pmu, [[0, 1, 2]], clock=self.clock)
+        with self.assertRaises(CounterAllocationError):
+            mux.start()
+
+class PMUGroupTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = BlockRegiceClientTest()
+        self.dev = Device(svd, self.client)
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.client.block_reads = 0
+        self.dev.pmus = {}
+        self.core0 = CorePMU(self.dev, 'core0', [self.dev.TEST1.TESTA,
+                                                 self.dev.TEST1.TESTB])
+        self.core1 = CorePMU(self.dev, 'core1', [self.dev.TEST1.TESTC,
+                                                 self.dev.TEST1.TESTD])
+        self.group = PMUGroup(self.dev, 'cpus', [self.core0, self.core1])
+        self.load0 = TestRatioPerfEvent(self.core0, 'load0',
+                                        list(self.core0.counters.values()))
+        self.load1 = TestRatioPerfEvent(self.core1, 'load1',
+                                        list(self.core1.counters.values()))
+        self.system = SystemLoad(self.group)
+        self.perf = Perf(self.dev)
+
+    def test_group(self):
+        self.assertEqual(self.group.get_core_events(Perf.CPU_LOAD),
+                         [self.load0, self.load1])
+        self.assertEqual(self.system.events, [self.load0, self.load1])
+        self.assertEqual(len(self.system.get_counters()), 4)
+        self.assertEqual(self.perf.get(Perf.SYSTEM_LOAD, 'System load'),
+                         self.system)
+        with self.assertRaises(ValueError):
+            PMUGroup(object(), 'other', [self.core0])
+
+    def test_enable(self):
+        self.system.enable()
+        self.assertTrue(self.group.enabled())
+        self.assertTrue(self.core0.en and self.core1.en)
+        self.assertTrue(self.load0.enabled())
+        self.system.disable()
+        self.assertFalse(self.core0.en or self.core1.en)
+        self.assertFalse(self.load1.enabled())
+
+    def test_snapshot_merged(self):
+        snapshots = self.group.snapshot_all()
+        self.assertEqual(self.client.block_reads, 1)
+        self.assertEqual(snapshots['core0']['TESTA'], 0x100003)
+        self.assertEqual(snapshots['core1']['TESTD'], 0x7)
+        self.assertIs(snapshots['core1'].pmu, self.core1)
+        self.assertEqual(snapshots['core0'].timestamp,
+                         snapshots['core1'].timestamp)
+
+        snapshots = self.group.snapshot_all({'core1': ['TESTC']})
+        self.assertEqual(len(snapshots['core0']), 0)
+        self.assertEqual(list(snapshots['core1']), ['TESTC'])
+
+    def test_snapshot_parallel(self):
+        self.group.parallel = True
+        try:
+            snapshots = self.group.snapshot_all()
+            with self.group.tick():
+                self.group.snapshot_all()
+                reads = self.client.reads
+                self.assertEqual(self.core1.read('TESTD'), 0x7)
+                self.assertEqual(self.client.reads, reads)
+        finally:
+            self.group.close()
+        self.assertEqual(snapshots['core0']['TESTB'], 0x10000)
+        self.assertEqual(snapshots['core1']['TESTC'], 0x5)
+        self.assertIs(self.group.executor, None)
+
+    def test_tick(self):
+        with self.group.tick():
+            self.assertIsNotNone(self.core0.read_cache)
+            self.group.snapshot_all()
+            reads = self.client.reads
+            self.group.snapshot_all()
+            self.assertEqual(self.client.reads, reads)
+        self.assertIsNone(self.core1.read_cache)
+
+        cache = ReadCache()
+        with self.group.tick(cache=cache):
+            self.assertIs(self.core0.read_cache, cache)
+            self.assertIs(self.core1.read_cache, cache)
+
+    def test_values(self):
+        values = self.system.get_core_values()
+        self.assertEqual(self.client.block_reads, 1)
+        self.assertEqual(values[self.load0], 100 * 0x100003 / 0x10000)
+        self.assertEqual(values[self.load1], 100 * 0x5 / 0x7)
+        self.assertEqual(self.system.get_value(),
+                         (values[self.load0] + values[self.load1]) / 2)
+
+        values = self.perf.get_values([self.system, self.load0])
+        self.assertEqual(values[self.load0], 100 * 0x100003 / 0x10000)
+
+    def test_sample(self):
+        sampler = Sampler(self.perf, [self.system])
+        sampler.sample()
+        timestamp, raws, value = sampler.get_last(self.system)
+        self.assertEqual(raws, (0x100003, 0x10000, 0x5, 0x7))
+        self.assertEqual(value, self.system.get_value())
+
+class PMUSnapshotTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = BlockRegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.client.block_reads = 0
+        self.pmu = TestPMU(self.dev, 'test')
+
+    def test_snapshot(self):
+        snapshot = self.pmu.snapshot()
+        self.assertEqual(snapshot.read('TESTA'), 0x100003)
+        self.assertEqual(snapshot['TESTB'], 0x10000)
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(self.client.block_reads, 1)
+        self.assertEqual(snapshot.read_virtual('TESTA'), 0x100003)
+
+        with self.assertRaises(TypeError):
+            snapshot.values['TESTA'] = 0
+
+    def test_snapshot_counters(self):
+        snapshot = self.pmu.snapshot(['TESTB'])
+        self.assertEqual(snapshot.get_counters(), ['TESTB'])
+        self.assertEqual(self.client.block_reads, 0)
+
+    def test_snapshot_unallocated(self):
+        self.pmu.events = {0: ['test', 'test']}
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTA)
+        TestPMUCounter(self.pmu, self.pmu.device.TEST1.TESTB)
+        self.assertEqual(len(self.pmu.snapshot()), 0)
+
+        self.pmu.enable_event(0)
+        self.assertEqual(self.pmu.snapshot().get_counters(), ['TESTA'])
+
+    def test_snapshot_no_block_read(self):
+        self.pmu.snapshot_max_gap = -1
+        snapshot = self.pmu.snapshot()
+        self.assertEqual(snapshot['TESTA'], 0x100003)
+        self.assertEqual(self.client.block_reads, 0)
+
+    def test_snapshot_stats(self):
+        width = self.pmu.counters['TESTA'].width
+        self.pmu.enable_stats()
+        with self.pmu.tick():
+            self.pmu.snapshot()
+            self.pmu.read('TESTA')
+        self.pmu.reset()
+
+        stats = self.pmu.stats()
+        self.assertEqual(stats[('test', 'read_block', None)]['count'], 1)
+        self.assertEqual(stats[('test', 'read_block', None)]['bytes'],
+                         2 * width // 8)
+        self.assertEqual(stats[('TESTA', 'cache_hit', None)]['count'], 1)
+        self.assertEqual(stats[('TESTA', 'cache_hit', None)]['bytes'], 0)
+        self.assertNotIn(('TESTA', 'read', None), stats)
+        self.assertEqual(stats[('test', 'reset', None)]['bytes'],
+                         2 * width // 8)
+
+        self.pmu.disable_stats()
+        self.assertNotIn('read_block', self.client.__dict__)
+        self.assertNotIn('_read_block', self.pmu.__dict__)
+
+    def test_tick(self):
+        with self.pmu.tick():
+            self.assertEqual(self.pmu.read('TESTA'), 0x100003)
+            self.dev.TEST1.TESTA.write(4)
+            self.assertEqual(self.pmu.read('TESTA'), 0x100003)
+            self.assertEqual(self.pmu.snapshot()['TESTA'], 0x100003)
+            self.assertEqual(self.client.block_reads, 0)
+
+            self.pmu.clear_read_cache()
+            self.assertEqual(self.pmu.read('TESTA'), 4)
+        self.assertEqual(self.pmu.read_cache, None)
+
+    def test_tick_thread(self):
+        values = []
+        with self.pmu.tick():
+            self.pmu.read('TESTA')
+            self.dev.TEST1.TESTA.write(4)
+            thread = threading.Thread(
+                target=lambda: values.append(self.pmu.read('TESTA')))
+            thread.start()
+            thread.join()
+            self.assertEqual(self.pmu.read('TESTA'), 0x100003)
+        self.assertEqual(values, [4])
+
+        cache = ReadCache()
+        with self.pmu.tick(cache=cache):
+            self.pmu.read('TESTB')
+        with self.pmu.tick(cache=cache):
+            self.assertIs(self.pmu.read_cache, cache)
+            self.assertEqual(self.pmu.cache_lookup(self.pmu.counters['TESTB']),
+                             0x10000)
+
+    def test_tick_concurrent(self):
+        stop = threading.Event()
+
+        def ticks():
+            while not stop.is_set():
+                self.pmu.begin_tick()
+                self.pmu.end_tick()
+
+        thread = threading.Thread(target=ticks)
+        thread.start()
+        try:
+            for _ in range(1000):
+                self.assertEqual(self.pmu.read('TESTA'), 0x100003)
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_tick_ttl(self):
+        self.pmu.begin_tick(ttl=0)
+        self.pmu.read('TESTA')
+        self.dev.TEST1.TESTA.write(4)
+        time.sleep(0.001)
+        self.assertEqual(self.pmu.read('TESTA'), 4)
+        self.pmu.end_tick()
+
+    def test_consistent_snapshot(self):
+        snapshot = self.pmu.consistent_snapshot()
+        self.assertFalse(self.pmu.paused)
+        self.assertEqual(snapshot['TESTA'], 0x100003)
+        self.assertEqual(snapshot.pause_time, self.pmu.last_pause_time)
+        self.assertGreaterEqual(snapshot.pause_time, 0)
+        self.assertEqual(self.pmu.pause_count, 1)
+
+    def test_consistent_snapshot_tick(self):
+        with self.pmu.tick():
+            self.pmu.read('TESTA')
+            self.dev.TEST1.TESTA.write(42)
+            snapshot = self.pmu.consistent_snapshot(['TESTA'])
+            self.assertEqual(snapshot['TESTA'], 42)
+            self.assertEqual(self.pmu.read('TESTA'), 42)
+
+    def test_pause_window(self):
+        with self.assertRaises(ValueError):
+            with self.pmu.pause_window():
+                self.assertTrue(self.pmu.paused)
+                raise ValueError
+        self.assertFalse(self.pmu.paused)
+        self.assertEqual(self.pmu.pause_count, 1)
+
 class PMUEventTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -283,15 +1363,31 @@ class PerfTestCase(unittest.TestCase):
 
     def test_get_events(self):
         events = self.perf.get_events()
-        self.assertEqual(events, [self.perf_event1, self.perf_event2])
+        self.assertEqual(events, (self.perf_event1, self.perf_event2))
+        with self.assertRaises(AttributeError):
+            events.append(None)
 
         events = self.perf.get_events(Perf.CPU_LOAD)
-        self.assertEqual(events, [self.perf_event1])
+        self.assertEqual(events, (self.perf_event1,))
 
         self.dev.pmus = {'test': self.pmu_no_perf}
         perf = Perf(self.dev)
         events = perf.get_events()
-        self.assertEqual(events, [])
+        self.assertEqual(events, ())
+
+    def test_update_atomic(self):
+        events = self.perf.get_events()
+        generation = self.perf.generation
+        self.pmu_no_perf.perf_events = None
+        PMU.changed(self.dev)
+        with self.assertRaises(AttributeError):
+            self.perf.update()
+        self.assertEqual(self.perf.generation, generation)
+        self.assertIs(self.perf.all_events, events)
+        self.assertEqual(self.perf.events_by_key[(Perf.CPU_LOAD, 'test1')],
+                         self.perf_event1)
+        self.pmu_no_perf.perf_events = {}
+        self.assertEqual(self.perf.get_events(), events)
 
     def test_get_events_name(self):
         names = self.perf.get_events_name()
@@ -327,6 +1423,384 @@ class PerfTestCase(unittest.TestCase):
         expected_value = device.TEST1.TESTA / device.TEST1.TESTB
         self.assertEqual(value, expected_value)
 
+    def test_get_values(self):
+        counters = self.pmu.counters
+        event3 = TestRatioPerfEvent(self.pmu, 'test3',
+                                    [counters['TESTB'], counters['TESTA']])
+        event4 = TestRatioPerfEvent(self.pmu, 'test4',
+                                    [counters['TESTA'], counters['TESTB']])
+        events = [self.perf_event1, event3, event4]
+        values = self.perf.get_values(events)
+        for event in events:
+            self.assertAlmostEqual(values[event], event.get_value())
+
+        with self.assertRaises(NotImplementedError):
+            self.perf.get_values([self.perf_event2])
+
+        self.dev.TEST1.TESTB.write(0)
+        values = self.perf.get_values([event3, event4])
+        self.assertEqual(values[event3], 0)
+        self.assertIsNone(values[event4])
+        self.assertIsNone(event4.get_value())
+
+        self.dev.TEST1.TESTA.write((1 << 60) + 1)
+        self.dev.TEST1.TESTB.write(3)
+        values = self.perf.get_values([event3, event4])
+        self.assertEqual(values[event4], event4.get_value())
+
+    def test_aget_value(self):
+        async def get_values():
+            return await asyncio.gather(
+                self.perf.aget_value(None, 'test1'),
+                self.perf.aget_value(None, 'test1'),
+                self.pmu.aread('TESTA'))
+        reads = []
+        get_value = self.perf_event1.get_value
+        self.perf_event1.get_value = lambda: reads.append(1) or get_value()
+
+        loop = asyncio.new_event_loop()
+        values = loop.run_until_complete(get_values())
+        loop.close()
+        self.assertEqual(values, [0x100003 / 0x10000] * 2 + [0x100003])
+        self.assertEqual(len(reads), 1)
+        del self.perf_event1.get_value
+
+    def test_stream(self):
+        async def get_samples():
+            samples = []
+            stream = self.perf.stream([self.perf_event1], 1000)
+            async for sample in stream:
+                samples.append(sample)
+                if len(samples) == 3:
+                    break
+            await stream.aclose()
+            return samples
+        loop = asyncio.new_event_loop()
+        samples = loop.run_until_complete(get_samples())
+        loop.close()
+        self.assertEqual(len(samples), 3)
+        self.assertEqual(samples[0][1],
+                         {self.perf_event1: 0x100003 / 0x10000})
+
+    def test_update(self):
+        perf_event3 = TestPerfEvent(self.pmu_no_perf, Perf.CPU_LOAD, 'test3')
+        self.assertEqual(self.perf.get(None, 'test3'), perf_event3)
+        self.assertEqual(self.perf.get_events(Perf.CPU_LOAD),
+                         (self.perf_event1, perf_event3))
+
+        perf_event3.remove()
+        self.assertEqual(self.perf.get(Perf.CPU_LOAD, 'test3'), None)
+
+        pmu = TestPMU(self.dev, 'test3')
+        perf_event4 = TestPerfEvent(pmu, Perf.MEMORY_LOAD, 'test4')
+        self.assertEqual(self.perf.get(Perf.MEMORY_LOAD, 'test4'), perf_event4)
+
+        pmu.remove()
+        self.assertEqual(self.perf.get(None, 'test4'), None)
+        self.assertEqual(self.perf.get_events(Perf.MEMORY_LOAD),
+                         (self.perf_event2,))
+
+    def test_get_events_cached(self):
+        self.assertIs(self.perf.get_events(), self.perf.get_events())
+
+class CollectorTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        self.perf_event = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test1')
+        self.perf = Perf(self.dev)
+        self.replay_dev = ReplayDevice()
+        self.hung = threading.Event()
+        self.failing_event = TestPerfEvent(ReplayPMU(self.replay_dev, 'hung',
+                                                     CaptureStub()),
+                                           Perf.CPU_LOAD, 'test2')
+        self.failing_perf = Perf(self.replay_dev)
+        hung = self.hung
+
+        def hang():
+            hung.wait()
+            raise ValueError
+        self.failing_event.get_value = hang
+
+    def test_tick(self):
+        collector = Collector({'dev': self.perf, 'hung': self.failing_perf},
+                              events={'dev': [self.perf_event],
+                                      'hung': [self.failing_event]})
+        collector.start(periodic=False)
+        self.assertEqual(collector.tick(1.0), [])
+        self.assertEqual(collector.get(1.0),
+                         (1.0, 'dev', {'test1': 0x100003 / 0x10000}, None))
+        self.assertEqual(collector.tick(2.0), ['hung'])
+        self.assertEqual(collector.get(1.0)[:2], (2.0, 'dev'))
+
+        self.hung.set()
+        timestamp, name, values, err = collector.get(1.0)
+        self.assertEqual((timestamp, name, values), (1.0, 'hung', None))
+        self.assertIsInstance(err, ValueError)
+        self.assertEqual(collector.get_status()['hung'], (False, 1, 1))
+        collector.stop()
+
+    def test_start_stop(self):
+        self.hung.set()
+        collector = Collector({'dev': self.perf}, rate=1000,
+                              events={'dev': [self.perf_event]})
+        collector.start()
+        self.assertNotEqual(collector.get(1.0), None)
+        collector.stop()
+
+    def test_stop_queued(self):
+        worker = DeviceWorker('hung', self.failing_perf, [self.failing_event],
+                              Collector({}).samples)
+        worker.start()
+        self.assertTrue(worker.request(1.0))
+        worker.requests.put(2.0)
+        worker.stop(0)
+        self.hung.set()
+        worker.thread.join(1.0)
+        self.assertFalse(worker.thread.is_alive())
+
+class PollSchedulerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = BlockRegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.client.block_reads = 0
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        counters = self.pmu.counters
+        self.event1 = TestRatioPerfEvent(self.pmu, 'test1',
+                                         [counters['TESTA'], counters['TESTB']])
+        self.event2 = TestRatioPerfEvent(self.pmu, 'test2',
+                                         [counters['TESTB'], counters['TESTA']])
+        self.perf = Perf(self.dev)
+
+    def test_plan(self):
+        scheduler = PollScheduler(self.perf)
+        values = []
+        callback = lambda event, value, timestamp: values.append(event.name)
+        sub1 = scheduler.subscribe(self.event1, 50, callback)
+        scheduler.subscribe(self.event2, 1, callback)
+        scheduler.subscribe(self.event1, 10, callback)
+        self.assertAlmostEqual(scheduler.interval, 0.02)
+        self.assertEqual([ticks for ticks, _, _ in scheduler.plan],
+                         [1, 5, 50])
+
+        self.assertEqual(scheduler.get_due(1), ([self.event1], [sub1]))
+        events, subs = scheduler.get_due(50)
+        self.assertEqual(events, [self.event1, self.event2])
+        self.assertEqual(len(subs), 3)
+
+        scheduler.tick()
+        self.assertEqual(sorted(values), ['test1', 'test1', 'test2'])
+        self.assertEqual(self.client.block_reads, 1)
+
+        scheduler.unsubscribe(sub1)
+        self.assertAlmostEqual(scheduler.interval, 0.1)
+        self.assertEqual([ticks for ticks, _, _ in scheduler.plan], [1, 10])
+
+    def test_start_stop(self):
+        scheduler = PollScheduler(self.perf)
+        values = []
+        polled = threading.Event()
+
+        def callback(event, value, timestamp):
+            values.append(value)
+            polled.set()
+        scheduler.subscribe(self.event1, 1000, callback)
+        scheduler.start()
+        self.assertTrue(polled.wait(5))
+        scheduler.stop()
+        self.assertAlmostEqual(values[0], 100 * 0x100003 / 0x10000)
+
+    def test_callback_error(self):
+        scheduler = PollScheduler(self.perf)
+        values = []
+
+        def fail(event, value, timestamp):
+            raise RuntimeError("subscriber failed")
+        scheduler.subscribe(self.event1, 10, fail)
+        scheduler.subscribe(self.event1, 10,
+                            lambda event, value, timestamp: values.append(value))
+        with self.assertWarns(UserWarning):
+            scheduler.tick()
+        self.assertEqual(len(values), 1)
+
+    def test_event_error(self):
+        scheduler = PollScheduler(self.perf)
+        values = []
+        failing = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'failing')
+
+        def fail():
+            raise RuntimeError("link error")
+        failing.get_value = fail
+        scheduler.subscribe(failing, 10, lambda *args: values.append(args))
+        scheduler.subscribe(self.event1, 10,
+                            lambda event, value, timestamp: values.append(value))
+        with self.assertWarns(UserWarning):
+            scheduler.tick()
+        self.assertEqual(len(values), 1)
+        self.assertAlmostEqual(values[0], 100 * 0x100003 / 0x10000)
+
+        with self.assertRaises(ValueError):
+            scheduler.subscribe(self.event1, 0, lambda *args: None)
+
+    def test_periodic_error(self):
+        calls = []
+        done = threading.Event()
+
+        def function(deadline):
+            calls.append(deadline)
+            if len(calls) == 1:
+                raise RuntimeError("link error")
+            done.set()
+        periodic = PeriodicThread(function, lambda: 0.001)
+        with self.assertWarns(UserWarning):
+            periodic.start()
+            self.assertTrue(done.wait(5))
+        periodic.stop()
+        self.assertFalse(periodic.running())
+
+class RingBufferTestCase(unittest.TestCase):
+    def test_append(self):
+        buf = RingBuffer(2, 1)
+        self.assertEqual(buf.last(), None)
+        buf.append(1.0, [10], 0.5)
+        buf.append(2.0, [20], None)
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(buf.get()[0], (1.0, (10,), 0.5))
+
+        buf.append(3.0, [30], 1.5)
+        self.assertEqual(len(buf), 2)
+        self.assertEqual([sample[0] for sample in buf.get()], [2.0, 3.0])
+        self.assertEqual(buf.last(), (3.0, (30,), 1.5))
+
+        buf.clear()
+        self.assertEqual(buf.get(), [])
+
+class SamplerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        file = open_svd_file('test.svd')
+        svd = SVDText(file.read())
+        svd.parse()
+        self.client = RegiceClientTest()
+        self.dev = Device(svd, self.client)
+        self.memory = self.client.memory
+
+    @classmethod
+    def setUp(self):
+        self.client.memory_restore()
+        self.dev.pmus = {}
+        self.pmu = TestPMU(self.dev, 'test')
+        self.perf_event1 = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test1')
+        self.perf_event1.counters = list(self.pmu.counters.values())
+        self.perf_event2 = TestPerfEvent(self.pmu, Perf.CPU_LOAD, 'test2')
+        self.perf = Perf(self.dev)
+
+    def test_sample(self):
+        self.perf_event1.enable()
+        sampler = Sampler(self.perf, capacity=4)
+        sampler.sample()
+        sampler.sample()
+
+        samples = sampler.get_samples(self.perf_event1)
+        self.assertEqual(len(samples), 2)
+        timestamp, raws, value = samples[-1]
+        self.assertEqual(raws, (0x100003, 0x10000))
+        self.assertEqual(value, self.perf_event1.get_value())
+        self.assertEqual(sampler.get_samples(self.perf_event2), [])
+        self.assertEqual(sampler.get_last(self.perf_event2), None)
+        self.perf_event1.disable()
+
+    def test_sample_error(self):
+        sampler = Sampler(self.perf, [self.perf_event1, self.perf_event2])
+        self.perf_event2.get_value = lambda: 1 // 0
+        with self.assertWarns(UserWarning):
+            sampler.sample()
+        timestamp, raws, value = sampler.get_last(self.perf_event2)
+        self.assertTrue(math.isnan(value))
+        self.assertIsNotNone(sampler.get_last(self.perf_event1))
+
+    def test_capacity(self):
+        with self.assertRaises(ValueError):
+            Sampler(self.perf, capacity=0)
+        with self.assertRaises(ValueError):
+            RingBuffer(0, 1)
+        sampler = Sampler(self.perf, [self.perf_event2], capacity=3)
+        for _ in range(5):
+            sampler.sample()
+        self.assertEqual(len(sampler.get_samples(self.perf_event2)), 3)
+
+    def test_adaptive_interval(self):
+        sampler = Sampler(self.perf, [self.perf_event1], max_latency=2.0,
+                          min_interval=0.01)
+        sampler.sample()
+        self.assertEqual(sampler.interval, 0.1)
+
+        counter = self.pmu.counters['TESTA']
+        sampler.rates[counter] = (counter.mask + 1) / 1.0
+        sampler._adapt_interval()
+        self.assertEqual(sampler.interval, 0.1)
+
+        sampler.rates[self.pmu.counters['TESTB']] = 0
+        for interval in [0.2, 0.4, 0.5, 0.5]:
+            sampler._adapt_interval()
+            self.assertEqual(sampler.interval, interval)
+
+        sampler.rates[counter] = (counter.mask + 1) * 1000.0
+        sampler._adapt_interval()
+        self.assertEqual(sampler.interval, 0.01)
+
+        sampler.rates[counter] = 0
+        for interval in [0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.0]:
+            sampler._adapt_interval()
+            self.assertEqual(sampler.interval, interval)
+
+        sampler.set_rate(4.0)
+        for _ in range(4):
+            sampler._adapt_interval()
+        self.assertEqual(sampler.interval, 0.25)
+        sampler.rates[counter] = (counter.mask + 1) * 1000.0
+        sampler._adapt_interval()
+        self.assertEqual(sampler.interval, 0.01)
+
+    def test_update_rates(self):
+        sampler = Sampler(self.perf, [self.perf_event1], max_latency=2.0)
+        sampler.sample()
+        self.dev.TEST1.TESTA.write(0x100003 + 1000)
+        sampler.sample()
+        self.assertGreater(sampler.rates[self.pmu.counters['TESTA']], 0)
+        self.assertEqual(sampler.rates[self.pmu.counters['TESTB']], 0)
+
+    def test_start_stop(self):
+        sampler = Sampler(self.perf, [self.perf_event1], rate=1000)
+        sampled = threading.Event()
+        sampler.add_listener(lambda event, timestamp, value: sampled.set())
+        sampler.start()
+        self.assertTrue(sampler.running())
+        self.assertTrue(sampled.wait(5))
+        sampler.stop()
+        self.assertFalse(sampler.running())
+
 def run_tests(module):
     return unittest.main(module=module, exit=False).result
 
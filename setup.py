@@ -41,6 +41,9 @@ setup(
         "Programming Language :: Python :: 3.6",
     ],
     install_requires=['LibRegice', 'RegiceCommon'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     dependency_links=[
         'git+https://github.com/BayLibre/libregice.git#egg=LibRegice',
         'git+https://github.com/BayLibre/regice-common.git#egg=RegiceCommon',